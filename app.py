@@ -1,22 +1,37 @@
-from flask import Flask, request, redirect, send_file, jsonify
+from flask import Flask, Response, request, redirect, send_file, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, insert, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from flask_cors import CORS
-from datetime import datetime
-import bcrypt
+from datetime import datetime, timedelta
 import random
 import json
-from io import BytesIO
 from decouple import config
 from base64 import b64decode
 import boto3
 import os
 import pyotp
-from collections import deque
+from uuid import uuid4
+from urllib.parse import quote
+from collections import Counter
+import click
 
 from send_verification_email import send_verification_email
-from twoFA import generate_twoFA_code, compare_twoFA_code
-from utils import pil_img_to_io, send_200, send_404, remove_files, reset_lp, directory_to_dict, file_to_dict
-from fc import compare_face_data
+from twoFA import generate_twoFA_key, twoFA_provisioning_uri, twoFA_code_etag, render_twoFA_code, compare_twoFA_code
+from utils import send_200, send_404, send_429, send_503, reset_lp, get_file_extension, directory_to_dict, file_to_dict, \
+    encode_cursor, decode_cursor
+from fc_pool import encode_face, FcPoolBusy, FcPoolTimeout
+from fc_batch import compare_face_encoding
+from search_index import SEARCH_LIMIT_MAX, SEARCH_CANDIDATE_BATCH, SEARCH_JOIN_KEYS, name_trigrams, query_trigrams, matches, \
+    cached_trigram_sizes, cache_trigram_sizes
+from listing_cache import listing_etag, get_listing, put_listing
+from zip_stream import stream_zip, archive_name
+from storage import transfer_executor, hash_executor, hash_file, upload_file, upload_files, get_object, delete_objects
+from password_hashing import admit_login, check_password, hash_password, needs_rehash, LoginThrottled, PasswordCheckBusy
+from serving import engine_options, s3_client_config
+import metrics
+from session_tokens import issue_token, get_request_token, read_token, is_trusted, mark_checked, revoke_tokens
 
 dev_mode = False
 
@@ -24,13 +39,24 @@ app = Flask(__name__)
 CORS(app)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = config("DATABASE_URL")
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 db = SQLAlchemy(app)
 session = boto3.Session(
     aws_access_key_id=config("AWS_ACCESS_KEY"),
     aws_secret_access_key=config("AWS_SECRET_KEY"),
-    profile_name="default"
+    profile_name=config("AWS_PROFILE_NAME", default="default") or None
 )
-s3_client = session.client("s3")
+# point at a local s3 stand-in (minio, moto_server) for development
+s3_client = session.client("s3", endpoint_url=config("AWS_S3_ENDPOINT_URL", default=None),
+                           config=s3_client_config())
+metrics.instrument_boto_client(s3_client)
+S3_PRESIGNED_EXPIRY = config("S3_PRESIGNED_EXPIRY", default=300, cast=int)
+# a row without an s3_name may still have a PUT in flight that started just
+# before its url expired, it is only treated as abandoned after this long
+PENDING_UPLOAD_TTL = config("PENDING_UPLOAD_TTL", default=2 * S3_PRESIGNED_EXPIRY, cast=int)
+MAX_DIRECTORY_DEPTH = config("MAX_DIRECTORY_DEPTH", default=64, cast=int)
+DIRECTORY_PAGE_SIZE_MAX = config("DIRECTORY_PAGE_SIZE_MAX", default=1000, cast=int)
+BATCH_MAX_FILES = config("BATCH_MAX_FILES", default=500, cast=int)
 # bucket = s3.Bucket(config("AWS_BUCKET_NAME"))
 
 
@@ -52,6 +78,7 @@ class FaceRecognition(db.Model):
     username = db.Column(db.String(100), primary_key=True)
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
     verified = db.Column(db.Boolean, default=False)
+    encoding = db.Column(db.LargeBinary)
 
 
 class User(db.Model):
@@ -78,6 +105,34 @@ class Directory(db.Model):
     name = db.Column(db.String(100), nullable=False)
     username = db.Column(db.String(100), nullable=False)
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    # bumped whenever anything below the directory changes, get_directory's etag
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # one index per get_directory sort key, id breaks ties so keyset pages are stable
+    __table_args__ = (
+        db.Index("ix_directory_parent_name", "parent_id", "name", "id"),
+        db.Index("ix_directory_parent_date", "parent_id", "date_created", "id"),
+    )
+
+
+class DirectoryClosure(db.Model):
+    # one row per (ancestor, descendant) pair including each directory itself
+    # at depth 0, so ancestry questions are a single indexed lookup
+    ancestor_id = db.Column(db.Integer, primary_key=True)
+    descendant_id = db.Column(db.Integer, primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+    __table_args__ = (
+        db.Index("ix_directory_closure_descendant", "descendant_id", "depth"),
+        db.Index("ix_directory_closure_ancestor_depth", "ancestor_id", "depth"),
+    )
+
+
+class Blob(db.Model):
+    # one s3 object per distinct content, shared by every File row with that hash
+    sha256 = db.Column(db.String(64), primary_key=True)
+    s3_name = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class File(db.Model):
@@ -88,13 +143,82 @@ class File(db.Model):
     name = db.Column(db.String(100), nullable=False)
     s3_name = db.Column(db.String(100))
     content_type = db.Column(db.String(45), nullable=False)
+    blob_sha256 = db.Column(db.String(64), index=True)
+    __table_args__ = (
+        db.Index("ix_file_directory_name", "directory_id", "name", "id"),
+        db.Index("ix_file_directory_date", "directory_id", "date_created", "id"),
+        db.Index("ix_file_directory_content_type", "directory_id", "content_type", "id"),
+    )
+
 
+class SearchTrigram(db.Model):
+    # posting lists for /search, kind is "d" or "f" and item_id the Directory or File id
+    username = db.Column(db.String(100), primary_key=True)
+    trigram = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(1), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    __table_args__ = (
+        db.Index("ix_search_trigram_item", "kind", "item_id"),
+    )
+
+
+def rebuild_directory_closure():
+    parents = dict(db.session.query(Directory.id, Directory.parent_id))
+    rows = []
+    for directory_id in parents:
+        ancestor_id, depth = directory_id, 0
+        while ancestor_id is not None and depth <= len(parents):
+            rows.append({"ancestor_id": ancestor_id, "descendant_id": directory_id, "depth": depth})
+            ancestor_id, depth = parents.get(ancestor_id, None), depth + 1
+    DirectoryClosure.query.delete()
+    db.session.bulk_insert_mappings(DirectoryClosure, rows)
+    db.session.commit()
+
+
+def rebuild_search_index(batch_size=10000):
+    SearchTrigram.query.delete()
+    rows = []
+    for kind, model in (("d", Directory), ("f", File)):
+        for item_id, username, name in db.session.query(model.id, model.username, model.name).yield_per(batch_size):
+            rows.extend({"username": username, "trigram": trigram, "kind": kind, "item_id": item_id}
+                        for trigram in name_trigrams(name))
+            if len(rows) >= batch_size:
+                db.session.bulk_insert_mappings(SearchTrigram, rows)
+                rows = []
+    db.session.bulk_insert_mappings(SearchTrigram, rows)
+    db.session.commit()
+
+
+metrics.init_app(app, lambda: db.engine)
 
 with app.app_context():
     db.create_all()
-    
 
-def validate_lp(username, window_id):
+
+@app.cli.command("backfill", help="Fill tables derived from existing rows.")
+@click.option("--force", is_flag=True, help="Rebuild even when the table already has rows.")
+def backfill(force):
+    # runs once per deploy (Procfile release), never at import where every
+    # gunicorn worker would race the others through the same delete and insert
+    if force or (not DirectoryClosure.query.first() and Directory.query.first()):
+        rebuild_directory_closure()
+        print("directory closure rebuilt")
+    if force or (not SearchTrigram.query.first() and (Directory.query.first() or File.query.first())):
+        rebuild_search_index()
+        print("search index rebuilt")
+
+
+def validate_lp(username, window_id, token=None):
+    with metrics.timer("validate_lp"):
+        return check_lp(username, window_id, token)
+
+
+def check_lp(username, window_id, token=None):
+    token = token or get_request_token(request)
+    # a signed token skips the db, it is confirmed against LoginProcess at most
+    # once per SESSION_TOKEN_RECHECK seconds per process
+    if token and read_token(token, username, window_id) and is_trusted(token):
+        return True
     lp = LoginProcess.query.get(username)
     if not lp:
         return False
@@ -106,8 +230,347 @@ def validate_lp(username, window_id):
     ):
         reset_lp(lp, window_id)
         return False
+    # the db is authoritative, resync in case a reset above was never committed
+    revoke_tokens(username, lp.date_created)
+    if token and read_token(token, username, window_id):
+        mark_checked(token)
     return True
 
+
+def add_directory(parent_id, name, username):
+    directory = Directory(parent_id=parent_id, name=name, username=username)
+    db.session.add(directory)
+    db.session.flush()
+    db.session.add(DirectoryClosure(ancestor_id=directory.id, descendant_id=directory.id, depth=0))
+    if parent_id is not None:
+        db.session.execute(insert(DirectoryClosure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(
+                DirectoryClosure.ancestor_id,
+                literal(directory.id),
+                DirectoryClosure.depth + 1
+            ).where(DirectoryClosure.descendant_id == parent_id)
+        ))
+    index_names(username, "d", [(directory.id, name)])
+    return directory
+
+
+def index_names(username, kind, items):
+    # items are (id, name) pairs of the rows just added or renamed
+    rows = [{"username": username, "trigram": trigram, "kind": kind, "item_id": item_id}
+            for item_id, name in items for trigram in name_trigrams(name)]
+    if rows:
+        db.session.bulk_insert_mappings(SearchTrigram, rows)
+
+
+def unindex_names(kind, item_ids):
+    for ids in chunked(list(item_ids)):
+        SearchTrigram.query.filter(SearchTrigram.kind == kind, SearchTrigram.item_id.in_(ids)).delete(
+            synchronize_session=False)
+
+
+def touch_directories(directory_ids):
+    # a change shows up in every listing that includes it, so the whole
+    # ancestor chain of each directory moves in one update
+    ancestors = select(DirectoryClosure.ancestor_id).where(DirectoryClosure.descendant_id.in_(list(directory_ids)))
+    Directory.query.filter(Directory.id.in_(ancestors)).update(
+        {Directory.version: Directory.version + 1}, synchronize_session=False)
+
+
+def directory_ancestors(directory_id):
+    # root first, the directory itself last
+    return db.session.query(Directory).join(
+        DirectoryClosure, Directory.id == DirectoryClosure.ancestor_id
+    ).filter(DirectoryClosure.descendant_id == directory_id).order_by(DirectoryClosure.depth.desc()).all()
+
+
+def directory_descendant_ids(directory_id, depth=None):
+    query = db.session.query(DirectoryClosure.descendant_id).filter(
+        DirectoryClosure.ancestor_id == directory_id)
+    if depth is not None:
+        query = query.filter(DirectoryClosure.depth <= depth)
+    return [row_id for (row_id,) in query]
+
+
+def chunked(items, size=1000):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def blob_key(sha256):
+    # the random suffix keeps a re-upload from reusing a key that a
+    # concurrent release is about to delete
+    return f"blob-{sha256}-{uuid4().hex[:8]}"
+
+
+def acquire_blob(sha256, size, s3_name=None):
+    # the row lock orders this against release_blobs dropping the same blob.
+    # new content is uploaded to s3_name before this is called, so the lock is
+    # only held until the caller commits, never for a transfer
+    blob = Blob.query.filter_by(sha256=sha256).with_for_update().first()
+    if blob:
+        blob.ref_count += 1
+        return blob, False
+    blob = Blob(sha256=sha256, s3_name=s3_name or blob_key(sha256), size=size, ref_count=1)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        return acquire_blob(sha256, size, s3_name)
+    return blob, True
+
+
+def release_blobs(files):
+    # files are (s3_name, blob_sha256) pairs, returns the s3 keys nobody references anymore
+    s3_names = [s3_name for s3_name, sha256 in files if s3_name and not sha256]
+    released = Counter(sha256 for _, sha256 in files if sha256)
+    for shas in chunked(sorted(released)):
+        blobs = Blob.query.filter(Blob.sha256.in_(shas)).with_for_update().all()
+        for blob in blobs:
+            blob.ref_count -= released[blob.sha256]
+            if blob.ref_count <= 0:
+                s3_names.append(blob.s3_name)
+                db.session.delete(blob)
+    return s3_names
+
+
+def delete_directory_tree(directory_id):
+    # ids are read once up front, mysql refuses a delete whose subquery reads
+    # the table being deleted from
+    directory_ids = directory_descendant_ids(directory_id)
+    files = []
+    for ids in chunked(directory_ids):
+        files.extend(db.session.query(File.id, File.s3_name, File.blob_sha256).filter(File.directory_id.in_(ids)))
+        File.query.filter(File.directory_id.in_(ids)).delete(synchronize_session=False)
+        Directory.query.filter(Directory.id.in_(ids)).delete(synchronize_session=False)
+        DirectoryClosure.query.filter(DirectoryClosure.descendant_id.in_(ids)).delete(synchronize_session=False)
+    unindex_names("f", [file_id for file_id, _, _ in files])
+    unindex_names("d", directory_ids)
+    return directory_ids, release_blobs([(s3_name, sha256) for _, s3_name, sha256 in files])
+
+
+def load_directory_tree(directory_id, depth=1):
+    # one closure lookup for the directories and one query for all of their files
+    rows = db.session.query(Directory, DirectoryClosure.depth).join(
+        DirectoryClosure, Directory.id == DirectoryClosure.descendant_id
+    ).filter(
+        DirectoryClosure.ancestor_id == directory_id,
+        DirectoryClosure.depth <= depth
+    ).order_by(DirectoryClosure.depth, Directory.id).all()
+    if not rows:
+        return None
+
+    root = rows[0][0]
+    nodes = {root.id: {"id": root.id, "name": root.name, "subdirectories": [], "files": []}}
+    for directory, directory_depth in rows[1:]:
+        node = directory_to_dict(directory)
+        if directory_depth < depth:
+            node["subdirectories"] = []
+            node["files"] = []
+            nodes[directory.id] = node
+        nodes[directory.parent_id]["subdirectories"].append(node)
+
+    files = File.query.filter(File.directory_id.in_(list(nodes))).order_by(File.id).all()
+    for file in files:
+        nodes[file.directory_id]["files"].append(file_to_dict(file))
+    return nodes[root.id]
+
+
+# directories have no content type, they keep name order under that sort
+DIRECTORY_SORT_COLUMNS = {"name": Directory.name, "dateCreated": Directory.date_created, "contentType": Directory.name}
+FILE_SORT_COLUMNS = {"name": File.name, "dateCreated": File.date_created, "contentType": File.content_type}
+
+
+def keyset_page(query, column, id_column, after, descending, limit):
+    # (column, id) past the cursor, written out so mysql can range scan the composite index
+    if after is not None:
+        value, row_id = after
+        if descending:
+            query = query.filter(db.or_(column < value, db.and_(column == value, id_column < row_id)))
+        else:
+            query = query.filter(db.or_(column > value, db.and_(column == value, id_column > row_id)))
+    if descending:
+        query = query.order_by(column.desc(), id_column.desc())
+    else:
+        query = query.order_by(column, id_column)
+    return query.limit(limit + 1).all()
+
+
+def load_directory_page(directory_id, page_size, sort="name", descending=False, cursor=None):
+    # subdirectories come first, then files. each request reads at most
+    # page_size + 1 rows per kind however large the directory is
+    root = Directory.query.get(directory_id)
+    if not root:
+        return None
+    kind, after = "d", None
+    if cursor:
+        kind, value, row_id = decode_cursor(cursor, date_value=sort == "dateCreated")
+        after = (value, row_id)
+
+    page = {"id": root.id, "name": root.name, "subdirectories": [], "files": [], "nextCursor": None}
+    if kind == "d":
+        column = DIRECTORY_SORT_COLUMNS[sort]
+        directories = keyset_page(Directory.query.filter(Directory.parent_id == root.id),
+                                  column, Directory.id, after, descending, page_size)
+        if len(directories) > page_size:
+            last = directories[page_size - 1]
+            page["subdirectories"] = [directory_to_dict(directory) for directory in directories[:page_size]]
+            page["nextCursor"] = encode_cursor("d", getattr(last, column.key), last.id)
+            return page
+        page["subdirectories"] = [directory_to_dict(directory) for directory in directories]
+        after = None
+    remaining = page_size - len(page["subdirectories"])
+    column = FILE_SORT_COLUMNS[sort]
+    files = keyset_page(File.query.filter(File.directory_id == root.id),
+                        column, File.id, after, descending, remaining)
+    if len(files) > remaining:
+        files = files[:remaining]
+        page["nextCursor"] = encode_cursor("f", getattr(files[-1], column.key), files[-1].id) if files \
+            else encode_cursor("d", getattr(directories[-1], DIRECTORY_SORT_COLUMNS[sort].key), directories[-1].id)
+    page["files"] = [file_to_dict(file) for file in files]
+    return page
+
+
+def resolve_duplicate_name(directory_id, file_name, content_type, exclude_id=None, pending_ids=()):
+    # runs inside the caller's transaction, nothing is committed here.
+    # pending_ids are rows the caller inserted itself, they still take a name
+    # but are never reaped as abandoned uploads
+    duplicates = File.query.filter_by(directory_id=directory_id, name=file_name, content_type=content_type)
+    if exclude_id is not None:
+        duplicates = duplicates.filter(File.id != exclude_id)
+    # rows without an s3_name are uploads that never completed, once their
+    # presigned url is long expired. whatever the client managed to put goes too
+    stale = duplicates.filter(
+        File.s3_name.is_(None),
+        File.date_created < datetime.utcnow() - timedelta(seconds=PENDING_UPLOAD_TTL)
+    )
+    if pending_ids:
+        stale = stale.filter(File.id.notin_(list(pending_ids)))
+    stale = [file_id for (file_id,) in stale.with_entities(File.id)]
+    if stale:
+        File.query.filter(File.id.in_(stale)).delete(synchronize_session=False)
+        unindex_names("f", stale)
+        bucket = config("AWS_BUCKET_NAME")
+        keys = [obj["Key"] for file_id in stale
+                for obj in s3_client.list_objects_v2(Bucket=bucket, Prefix=f"file-{file_id}.").get("Contents", [])]
+        delete_objects(s3_client, bucket, keys)
+    count = duplicates.count()
+    if count:
+        file_name += f"({count})"
+    return file_name
+
+
+def directory_archive_entries(directory_id):
+    # archive paths come from one closure lookup, parents sort before children by depth
+    directories = db.session.query(Directory).join(
+        DirectoryClosure, Directory.id == DirectoryClosure.descendant_id
+    ).filter(DirectoryClosure.ancestor_id == directory_id).order_by(DirectoryClosure.depth, Directory.id).all()
+    if not directories:
+        return None
+    paths = {}
+    taken = set()
+
+    def unique(path):
+        candidate, count = path, 0
+        while candidate in taken:
+            count += 1
+            candidate = f"{path}({count})"
+        taken.add(candidate)
+        return candidate
+
+    for directory in directories:
+        parent = paths.get(directory.parent_id, None) if directory.id != directory_id else None
+        paths[directory.id] = unique(f"{parent}/{archive_name(directory.name)}" if parent else archive_name(directory.name))
+    files = {}
+    for ids in chunked(list(paths)):
+        for file in File.query.filter(File.directory_id.in_(ids), File.s3_name.isnot(None)).order_by(File.name):
+            files.setdefault(file.directory_id, []).append(file)
+    entries = []
+    for directory in directories:
+        path = paths[directory.id]
+        entries.append((path + "/", None, None, directory.date_created))
+        for file in files.get(directory.id, []):
+            entries.append((unique(f"{path}/{archive_name(file.name)}"), file.s3_name, file.content_type, file.date_created))
+    return entries
+
+
+def directory_paths(directory_ids):
+    # "/entry/a/b" for each directory, from one closure lookup
+    paths = {}
+    for ids in chunked(list(directory_ids)):
+        rows = db.session.query(DirectoryClosure.descendant_id, Directory.name).join(
+            Directory, Directory.id == DirectoryClosure.ancestor_id
+        ).filter(DirectoryClosure.descendant_id.in_(ids)).order_by(
+            DirectoryClosure.descendant_id, DirectoryClosure.depth.desc())
+        for directory_id, name in rows:
+            paths.setdefault(directory_id, []).append(name)
+    return {directory_id: "/" + "/".join(names) for directory_id, names in paths.items()}
+
+
+def rarest_trigrams(username, kind, keys):
+    # posting list sizes only steer the plan, never the results, so sizes
+    # cached by an earlier search are good enough
+    keys = list(keys)
+    sizes = cached_trigram_sizes(username, kind, keys)
+    missing = [key for key in keys if key not in sizes]
+    if missing:
+        counted = dict(db.session.query(SearchTrigram.trigram, db.func.count()).filter(
+            SearchTrigram.username == username, SearchTrigram.trigram.in_(missing), SearchTrigram.kind == kind
+        ).group_by(SearchTrigram.trigram).all())
+        counted = {key: counted.get(key, 0) for key in missing}
+        cache_trigram_sizes(username, kind, counted)
+        sizes.update(counted)
+    return sorted(keys, key=sizes.get)[:SEARCH_JOIN_KEYS]
+
+
+def search_names(username, model, kind, query, prefix, limit):
+    # the rarest posting list is walked in id order, each entry confirmed by
+    # primary key lookups on the next rarest ones, then checked by name until
+    # enough of them really match
+    driver, *others = rarest_trigrams(username, kind, query_trigrams(query, prefix))
+    candidates = db.session.query(SearchTrigram.item_id).filter(
+        SearchTrigram.username == username, SearchTrigram.trigram == driver, SearchTrigram.kind == kind)
+    for key in others:
+        other = aliased(SearchTrigram)
+        candidates = candidates.join(other, db.and_(
+            other.username == SearchTrigram.username, other.trigram == key,
+            other.kind == SearchTrigram.kind, other.item_id == SearchTrigram.item_id))
+    found = []
+    after = 0
+    # a common query fills the page from the first few candidates, the batch
+    # only grows for queries whose trigrams co-occur without matching
+    size = min(max(limit * 2, 64), SEARCH_CANDIDATE_BATCH)
+    while len(found) < limit:
+        batch = [item_id for (item_id,) in candidates.filter(SearchTrigram.item_id > after).order_by(
+            SearchTrigram.item_id).limit(size)]
+        if not batch:
+            break
+        names = db.session.query(model.id, model.name).filter(model.id.in_(batch)).order_by(model.id)
+        found.extend(item_id for item_id, name in names if matches(name, query, prefix))
+        if len(batch) < size:
+            break
+        after = batch[-1]
+        size = min(size * 2, SEARCH_CANDIDATE_BATCH)
+    return model.query.filter(model.id.in_(found[:limit])).order_by(model.id).all() if found else []
+
+def get_reference_encoding(username):
+    fc = FaceRecognition.query.get(username)
+    if not fc:
+        return None
+    if fc.encoding:
+        return fc.encoding
+    # rows created before encodings were stored only have the s3 reference
+    res = s3_client.get_object(
+        Bucket=config("AWS_BUCKET_NAME"),
+        Key=f"{username}_reference.png",
+    )
+    reference_data = res.get("Body", None)
+    if not reference_data:
+        return None
+    fc.encoding = encode_face(reference_data.read())
+    db.session.commit()
+    return fc.encoding
+
 @app.route("/get_entry_directory")
 def get_entry_directory():
     username = request.args.get("username", None)
@@ -140,20 +603,44 @@ def get_directory():
     try:
         if not validate_lp(username, window_id) and not dev_mode:
             return send_404("invalid session")
-        directory = Directory.query.get(directory_id)
-        subdirectories = Directory.query.filter_by(
-            parent_id=directory_id).all()
-        for i, subdirectory in enumerate(subdirectories):
-            subdirectories[i] = directory_to_dict(subdirectory)
-        files = File.query.filter_by(directory_id=directory_id).all()
-        for i, file in enumerate(files):
-            files[i] = file_to_dict(file)
-        return jsonify({
-            "id": directory.id,
-            "name": directory.name,
-            "subdirectories": subdirectories,
-            "files": files
-        })
+        try:
+            directory_id = int(directory_id)
+            page_size = request.args.get("pageSize", None)
+            if page_size:
+                sort = request.args.get("sort", "name")
+                if sort not in FILE_SORT_COLUMNS:
+                    return send_404("invalid sort")
+                params = ("page", min(max(int(page_size), 1), DIRECTORY_PAGE_SIZE_MAX), sort,
+                          request.args.get("order", "asc") == "desc", request.args.get("cursor", None))
+            else:
+                params = ("tree", min(max(int(request.args.get("depth", 1)), 1), MAX_DIRECTORY_DEPTH))
+        except ValueError:
+            return send_404("invalid directory request")
+        # one primary key lookup decides between 304, a cached body and a rebuild
+        version = db.session.query(Directory.version).filter(Directory.id == directory_id).scalar()
+        if version is None:
+            return send_404("no directory found")
+        etag = listing_etag(directory_id, version, params)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            body = get_listing(directory_id, version, params)
+            if body is None:
+                try:
+                    if params[0] == "page":
+                        listing = load_directory_page(directory_id, *params[1:])
+                    else:
+                        listing = load_directory_tree(directory_id, params[1])
+                except ValueError:
+                    return send_404("invalid page request")
+                if not listing:
+                    return send_404("no directory found")
+                body = jsonify(listing).get_data()
+                put_listing(directory_id, version, params, body)
+            response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
     except Exception as e:
         print(e)
         return send_404("db error")
@@ -173,16 +660,100 @@ def create_directory():
         duplicates = Directory.query.filter_by(parent_id = parent_directory_id, name=directory_name, username=username).all()
         if duplicates:
             return send_404("directory already exists")
-        new_directory = Directory(parent_id=parent_directory_id, name=directory_name, username=username)
-        db.session.add(new_directory)
+        if not Directory.query.get(parent_directory_id):
+            return send_404("no parent directory found")
+        new_directory = add_directory(int(parent_directory_id), directory_name, username)
+        touch_directories([new_directory.parent_id])
         db.session.commit()
-        new_directory = Directory.query.filter_by(parent_id = parent_directory_id, name=directory_name, username=username).first()
         return jsonify(directory_to_dict(new_directory))
     except Exception as e:
         print(e)
         return send_404("db failed")
 
 
+@app.route("/get_directory_path")
+def get_directory_path():
+    username = request.args.get("username", None)
+    directory_id = request.args.get("directoryId", None)
+    window_id = request.args.get("windowId", None)
+    if not (username and directory_id and window_id):
+        return send_404("no credentials found")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        ancestors = directory_ancestors(directory_id)
+        if not ancestors:
+            return send_404("no directory found")
+        return jsonify([directory_to_dict(directory) for directory in ancestors])
+    except Exception as e:
+        print(e)
+        return send_404("db error")
+
+
+@app.route("/get_directory_zip")
+def get_directory_zip():
+    username = request.args.get("username", None)
+    directory_id = request.args.get("directoryId", None)
+    window_id = request.args.get("windowId", None)
+    if not (username and directory_id and window_id):
+        return send_404("no credentials found")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        directory = Directory.query.get(directory_id)
+        if not directory or directory.username != username:
+            return send_404("no directory found")
+        entries = directory_archive_entries(directory.id)
+        if entries is None:
+            return send_404("no directory found")
+        # the body is produced after the request returns, nothing in it touches the session
+        response = Response(
+            stream_zip(entries, s3_client, config("AWS_BUCKET_NAME"), transfer_executor),
+            mimetype="application/zip"
+        )
+        response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(archive_name(directory.name))}.zip"
+        return response
+    except Exception as e:
+        print(e)
+        return send_404("db error")
+
+
+@app.route("/search")
+def search():
+    username = request.args.get("username", None)
+    window_id = request.args.get("windowId", None)
+    query = request.args.get("query", "").strip()
+    prefix = request.args.get("mode", "substring") == "prefix"
+    if not (username and window_id and query):
+        return send_404("no credentials found")
+    if not prefix and len(query) < 3:
+        return send_404("substring search needs at least 3 characters")
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), SEARCH_LIMIT_MAX)
+    except ValueError:
+        return send_404("invalid limit")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        directories = search_names(username, Directory, "d", query, prefix, limit)
+        files = search_names(username, File, "f", query, prefix, limit)
+        paths = directory_paths({directory.id for directory in directories} | {file.directory_id for file in files})
+        results = {"directories": [], "files": []}
+        for directory in directories:
+            result = directory_to_dict(directory)
+            result["path"] = paths.get(directory.id, None)
+            results["directories"].append(result)
+        for file in files:
+            result = file_to_dict(file)
+            directory_path = paths.get(file.directory_id, None)
+            result["path"] = f"{directory_path}/{file.name}" if directory_path else None
+            results["files"].append(result)
+        return jsonify(results)
+    except Exception as e:
+        print(e)
+        return send_404("db error")
+
+
 @app.route("/delete_directory")
 def delete_directory():
     username = request.args.get("username", None)
@@ -197,19 +768,17 @@ def delete_directory():
         directory = Directory.query.get(directory_id)
         if not directory:
             return send_404("no directory found")
-        directoriesToDelete = deque([directory])
-        layer = 0
-        while directoriesToDelete:
-            for _ in range(len(directoriesToDelete)):
-                curr = directoriesToDelete.popleft()
-                children = Directory.query.filter_by(parent_id=curr.id).all()
-                if children and layer < 10:
-                    directoriesToDelete.extend(children) 
-                db.session.delete(curr)
-            layer += 1
+        # blob rows are locked before directory rows, as in every other write path
+        _, s3_names = delete_directory_tree(directory.id)
+        if directory.parent_id is not None:
+            touch_directories([directory.parent_id])
         db.session.commit()
+        errors = delete_objects(s3_client, config("AWS_BUCKET_NAME"), s3_names)
+        if errors:
+            print(errors)
         return send_200("directory deleted")
-    except:
+    except Exception as e:
+        print(e)
         return send_404("db failed")
 
 
@@ -227,21 +796,57 @@ def get_file():
     try:
         if not validate_lp(username, window_id) and not dev_mode:
             return send_404("invalid session")
-        res = s3_client.get_object(
-            Bucket=config("AWS_BUCKET_NAME"),
-            Key=file_s3_name,
+        if request.args.get("direct", None) == "true":
+            url = s3_client.generate_presigned_url(
+                "get_object",
+                Params={
+                    "Bucket": config("AWS_BUCKET_NAME"),
+                    "Key": file_s3_name,
+                    "ResponseContentDisposition": f"inline; filename=\"{file_name}\""
+                },
+                ExpiresIn=S3_PRESIGNED_EXPIRY
+            )
+            return jsonify({"url": url, "expiresIn": S3_PRESIGNED_EXPIRY})
+        byte_range = request.range
+        res = get_object(
+            s3_client,
+            config("AWS_BUCKET_NAME"),
+            file_s3_name,
+            byte_range=byte_range.to_header() if byte_range and len(byte_range.ranges) == 1 else None,
+            if_none_match=request.headers.get("If-None-Match", None),
+            if_modified_since=request.headers.get("If-Modified-Since", None)
         )
+        status = res.get("StatusCode", None)
+        if status == 304:
+            response = Response(status=304)
+            for header, value in (("ETag", res["ETag"]), ("Last-Modified", res["LastModified"])):
+                if value:
+                    response.headers[header] = value
+            return response
+        if status == 416:
+            response = Response(status=416)
+            response.headers["Content-Range"] = f"bytes */{res['ObjectSize']}"
+            return response
         content_type = res.get("ContentType", None)
         file_data = res.get("Body", None)
-        print(content_type)
         if not (file_data and content_type):
             return send_404("incomplete file")
-        return send_file(
+        response = send_file(
             file_data,
             mimetype=content_type,
             # as_attachment=True,
-            download_name=file_name
+            download_name=file_name,
+            conditional=False,
+            etag=False
         )
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["ETag"] = res["ETag"]
+        response.last_modified = res["LastModified"]
+        response.content_length = res["ContentLength"]
+        if res.get("ContentRange", None):
+            response.status_code = 206
+            response.headers["Content-Range"] = res["ContentRange"]
+        return response
     except:
         return send_404("db failed")
 
@@ -268,43 +873,244 @@ def create_file():
     if not (username and window_id and file_name and directory_id and content_type):
         return send_404("no credentials found")
     try:
-        if not validate_lp(username, window_id) and not dev_mode:
+        if not validate_lp(username, window_id, request_data.get("token", None)) and not dev_mode:
             return send_404("invalid session")
-        if content_type == "text/plain":
-            file_extension = file_name.split(".")[-1]
-        else:
-            file_extension = content_type.split("/")[-1]
+        file_extension = get_file_extension(file_name, content_type)
         if not file_extension:
             return send_404("no file extension")
-        duplicates = File.query.filter_by(directory_id=directory_id, name=file_name, content_type=content_type).all()
-        if duplicates:
-            toDelete = []
-            for duplicate in duplicates:
-                if not duplicate.s3_name:
-                    toDelete.append(duplicate)
-            for duplicate in toDelete:
-                db.session.delete(duplicate)
+        new_file = File(directory_id=directory_id, name=file_name, content_type=content_type, username=username)
+        db.session.add(new_file)
+        # the upload is hashed while the row is inserted
+        digest = hash_executor.submit(hash_file, file)
+        try:
+            db.session.flush()
+        finally:
+            # the stream belongs to this request, never return while it is being read
+            sha256, size = digest.result()
+        bucket = config("AWS_BUCKET_NAME")
+        # new content streams to a fresh key while the name is resolved, no
+        # blob row is locked yet so a concurrent upload of the same bytes never waits on it
+        uploaded = None
+        upload = None
+        if not Blob.query.get(sha256):
+            uploaded = blob_key(sha256)
+            upload = transfer_executor.submit(upload_file, s3_client, bucket, uploaded, file)
+        try:
+            new_file.name = resolve_duplicate_name(directory_id, file_name, content_type, exclude_id=new_file.id)
+        finally:
+            upload_error = upload.exception() if upload else None
+        if upload_error:
+            db.session.rollback()
+            raise upload_error
+        # the object this request put in s3 that nothing references until the commit
+        pending = uploaded
+        try:
+            blob, created = acquire_blob(sha256, size, uploaded)
+            if created and not uploaded:
+                # the blob was released between the check and the lock
+                pending = blob.s3_name
+                upload_file(s3_client, bucket, blob.s3_name, file)
+            new_file.s3_name = blob.s3_name
+            new_file.blob_sha256 = sha256
+            index_names(username, "f", [(new_file.id, new_file.name)])
+            touch_directories([new_file.directory_id])
+            db.session.commit()
+        except:
+            db.session.rollback()
+            if pending:
+                s3_client.delete_object(Bucket=bucket, Key=pending)
+            raise
+        if uploaded and not created:
+            # another upload of the same bytes got its blob in first
+            s3_client.delete_object(Bucket=bucket, Key=uploaded)
+        return jsonify(file_to_dict(new_file))
+    except Exception as e:
+        print(e)
+        return send_404("db failed")
+
+
+@app.route("/create_files", methods=["POST"])
+def create_files():
+    # multipart with one "data" part and the "file" parts in the order of data["files"]
+    files = request.files.getlist("file")
+    data = request.files.get("data", None)
+    if not (files and data):
+        return send_404("missing information")
+    try:
+        request_data = json.loads(data.read().decode('utf-8'))
+    except Exception as e:
+        print(e)
+        return send_404("could not decode request data")
+    username = request_data.get("username", None)
+    window_id = request_data.get("windowId", None)
+    directory_id = request_data.get("directoryId", None)
+    items = request_data.get("files", None)
+    if not (username and window_id and directory_id and items):
+        return send_404("no credentials found")
+    if len(items) != len(files):
+        return send_404("file count does not match request data")
+    if len(items) > BATCH_MAX_FILES:
+        return send_404(f"at most {BATCH_MAX_FILES} files per request")
+    try:
+        if not validate_lp(username, window_id, request_data.get("token", None)) and not dev_mode:
+            return send_404("invalid session")
+        directory = Directory.query.get(directory_id)
+        if not directory or directory.username != username:
+            return send_404("no directory found")
+        results = [None] * len(items)
+        accepted = []
+        for i, (item, file) in enumerate(zip(items, files)):
+            file_name = item.get("fileName", None)
+            content_type = item.get("contentType", None) or "text/plain"
+            if not file_name:
+                results[i] = {"error": "no file name"}
+            elif not get_file_extension(file_name, content_type):
+                results[i] = {"error": "no file extension"}
+            else:
+                accepted.append((i, file_name, content_type, file))
+        digests = [digest.result() for digest in [hash_executor.submit(hash_file, file) for _, _, _, file in accepted]]
+        shas = sorted({sha256 for sha256, _ in digests})
+        existing = set()
+        for chunk in chunked(shas):
+            existing.update(sha256 for (sha256,) in db.session.query(Blob.sha256).filter(Blob.sha256.in_(chunk)))
+        # new content goes to fresh keys before any blob row is locked, one
+        # upload per distinct hash even when the batch repeats a file
+        uploads = {}
+        for (_, _, _, file), (sha256, _) in zip(accepted, digests):
+            if sha256 not in existing and sha256 not in uploads:
+                uploads[sha256] = (blob_key(sha256), file)
+        bucket = config("AWS_BUCKET_NAME")
+        new_files = {}
+        for i, file_name, content_type, _ in accepted:
+            new_file = File(directory_id=directory.id, name=file_name, content_type=content_type, username=username)
+            db.session.add(new_file)
+            db.session.flush()
+            new_file.name = resolve_duplicate_name(directory.id, file_name, content_type, exclude_id=new_file.id,
+                                                   pending_ids=[pending.id for pending in new_files.values()])
+            new_files[i] = new_file
+        failed = upload_files(s3_client, bucket, list(uploads.values()), transfer_executor)
+        # the objects this request put in s3 that nothing references until the commit
+        pending = [key for key, _ in uploads.values() if key not in failed]
+        redundant = []
+        sizes = dict(digests)
+        references = Counter(sha256 for sha256, _ in digests)
+        files_by_sha = {sha256: file for (_, _, _, file), (sha256, _) in zip(accepted, digests)}
+        try:
+            # blob rows are locked in hash order so concurrent batches cannot deadlock
+            blobs = {}
+            for sha256 in shas:
+                key = uploads[sha256][0] if sha256 in uploads else None
+                if key in failed:
+                    continue
+                blob, created = acquire_blob(sha256, sizes[sha256], key)
+                blob.ref_count += references[sha256] - 1
+                if created and not key:
+                    # the blob was released between the check and the lock
+                    pending.append(blob.s3_name)
+                    upload_file(s3_client, bucket, blob.s3_name, files_by_sha[sha256])
+                elif key and not created:
+                    # another upload of the same bytes got its blob in first
+                    redundant.append(key)
+                blobs[sha256] = blob
+            for (i, _, _, _), (sha256, _) in zip(accepted, digests):
+                new_file = new_files[i]
+                if sha256 in blobs:
+                    new_file.s3_name = blobs[sha256].s3_name
+                    new_file.blob_sha256 = sha256
+                else:
+                    db.session.delete(new_file)
+                    results[i] = {"error": "upload failed"}
+            index_names(username, "f",
+                        [(new_file.id, new_file.name) for i, new_file in new_files.items() if not results[i]])
+            touch_directories([directory.id])
             db.session.commit()
-            duplicates = File.query.filter_by(directory_id=directory_id, name=file_name, content_type=content_type).all()
-            if duplicates:
-                file_name += f"({len(duplicates)})"
+        except:
+            db.session.rollback()
+            delete_objects(s3_client, bucket, pending, executor=transfer_executor)
+            raise
+        delete_objects(s3_client, bucket, redundant, executor=transfer_executor)
+        for i, new_file in new_files.items():
+            if not results[i]:
+                results[i] = {"file": file_to_dict(new_file)}
+        return jsonify({"results": results})
+    except Exception as e:
+        print(e)
+        db.session.rollback()
+        return send_404("db failed")
+
+
+@app.route("/create_file_upload")
+def create_file_upload():
+    username = request.args.get("username", None)
+    window_id = request.args.get("windowId", None)
+    file_name = request.args.get("fileName", None)
+    directory_id = request.args.get("directoryId", None)
+    content_type = request.args.get("contentType", None)
+    if not content_type:
+        content_type = "text/plain"
+    if not (username and window_id and file_name and directory_id):
+        return send_404("no credentials found")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        file_extension = get_file_extension(file_name, content_type)
+        if not file_extension:
+            return send_404("no file extension")
+        file_name = resolve_duplicate_name(directory_id, file_name, content_type)
+        # the row stays without an s3_name until finalize_file_upload sees the object
         new_file = File(directory_id=directory_id, name=file_name, content_type=content_type, username=username)
         db.session.add(new_file)
+        db.session.flush()
+        index_names(username, "f", [(new_file.id, new_file.name)])
+        touch_directories([directory_id])
         db.session.commit()
-        new_file = File.query.filter_by(directory_id=directory_id, name=file_name, content_type=content_type).first()
-        new_file_id = new_file.id
-        s3_name = f"file-{str(new_file_id)}.{file_extension}"
-        new_file.s3_name = s3_name
-        db.session.commit()
-        s3_client.put_object(
+        upload_url = s3_client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": config("AWS_BUCKET_NAME"),
+                "Key": f"file-{str(new_file.id)}.{file_extension}"
+            },
+            ExpiresIn=S3_PRESIGNED_EXPIRY
+        )
+        return jsonify({
+            "file": file_to_dict(new_file),
+            "uploadUrl": upload_url,
+            "expiresIn": S3_PRESIGNED_EXPIRY
+        })
+    except Exception as e:
+        print(e)
+        return send_404("db failed")
+
+
+@app.route("/finalize_file_upload")
+def finalize_file_upload():
+    username = request.args.get("username", None)
+    window_id = request.args.get("windowId", None)
+    file_id = request.args.get("fileId", None)
+    if not (username and window_id and file_id):
+        return send_404("no credentials found")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        file = File.query.get(file_id)
+        if not file or file.username != username:
+            return send_404("no file found")
+        if file.s3_name:
+            return jsonify(file_to_dict(file))
+        # the name may have gained a "(n)" suffix, so look the key up by prefix
+        # rather than recomputing the extension
+        res = s3_client.list_objects_v2(
             Bucket=config("AWS_BUCKET_NAME"),
-            Key=s3_name,
-            Body=file
+            Prefix=f"file-{str(file.id)}.",
+            MaxKeys=1
         )
-        new_file = File.query.get(new_file_id)
-        if not new_file:
-            return send_404("wtf")
-        return jsonify(file_to_dict(new_file))
+        uploaded = res.get("Contents", None)
+        if not uploaded:
+            return send_404("upload not found")
+        file.s3_name = uploaded[0]["Key"]
+        touch_directories([file.directory_id])
+        db.session.commit()
+        return jsonify(file_to_dict(file))
     except Exception as e:
         print(e)
         return send_404("db failed")
@@ -326,17 +1132,58 @@ def delete_file():
         if not file:
             return send_404("no file found")
         file_copy = file_to_dict(file)
+        s3_names = release_blobs([(file.s3_name, file.blob_sha256)])
+        touch_directories([file.directory_id])
+        unindex_names("f", [file.id])
         db.session.delete(file)
         db.session.commit()
-        s3_client.delete_object(
-            Bucket=config("AWS_BUCKET_NAME"),
-            Key=file_s3_name
-        )
+        # the object only goes once the last file referencing it is gone
+        delete_objects(s3_client, config("AWS_BUCKET_NAME"), s3_names)
         return jsonify(file_copy)
     except Exception as e:
         return send_404("db failed")
 
 
+@app.route("/delete_files")
+def delete_files():
+    username = request.args.get("username", None)
+    window_id = request.args.get("windowId", None)
+    file_ids = request.args.get("fileIds", None)
+    if not (username and window_id and file_ids):
+        return send_404("no credentials found")
+    try:
+        file_ids = [int(file_id) for file_id in file_ids.split(",")]
+    except ValueError:
+        return send_404("invalid file ids")
+    if len(file_ids) > BATCH_MAX_FILES:
+        return send_404(f"at most {BATCH_MAX_FILES} files per request")
+    try:
+        if not validate_lp(username, window_id) and not dev_mode:
+            return send_404("invalid session")
+        files = {}
+        for ids in chunked(file_ids):
+            files.update((file.id, file) for file in File.query.filter(File.id.in_(ids), File.username == username))
+        results = [
+            {"id": file_id, "file": file_to_dict(files[file_id])} if file_id in files
+            else {"id": file_id, "error": "no file found"}
+            for file_id in file_ids
+        ]
+        s3_names = release_blobs([(file.s3_name, file.blob_sha256) for file in files.values()])
+        for ids in chunked(list(files)):
+            File.query.filter(File.id.in_(ids)).delete(synchronize_session=False)
+        if files:
+            unindex_names("f", files)
+            touch_directories({file.directory_id for file in files.values()})
+        db.session.commit()
+        errors = delete_objects(s3_client, config("AWS_BUCKET_NAME"), s3_names, executor=transfer_executor)
+        if errors:
+            print(errors)
+        return jsonify({"results": results})
+    except Exception as e:
+        print(e)
+        return send_404("db failed")
+
+
 @app.route("/password_login")
 def password_login():
     username = request.args.get("username", None)
@@ -344,21 +1191,33 @@ def password_login():
     window_id = request.args.get("windowId", None)
     if not (username and password and window_id):
         return send_404("no credentials found")
+    try:
+        admit_login(username)
+    except LoginThrottled:
+        return send_429("too many login attempts")
     user = User.query.get(username)
     if not user:
         return send_404("user does not exist")
-    if not bcrypt.checkpw(password.encode("utf8"), user.password.encode("utf8")):
-        return send_404("password incorrect")
+    try:
+        if not check_password(password, user.password):
+            return send_404("password incorrect")
+    except PasswordCheckBusy:
+        return send_503("login busy")
+    if needs_rehash(user.password):
+        try:
+            user.password = hash_password(password)
+        except PasswordCheckBusy:
+            # the password is already confirmed, the upgrade waits for a quieter login
+            pass
     try:
         lp = LoginProcess.query.get(username)
         if not lp:
             lp = LoginProcess(username=username, window_id=window_id)
             db.session.add(lp)
-            db.session.commit()
         else:
             if lp.window_id != window_id:
                 reset_lp(lp, window_id)
-                db.session.commit()
+        db.session.commit()
         return send_200("password correct")
     except:
         return send_404("db failed")
@@ -381,17 +1240,24 @@ def twoFA_login():
         reset_lp(lp, window_id)
         db.session.commit()
         return send_404("login session expired")
-    if lp.twoFA_verified:
-        return send_200("twoFA already verifyed")
     try:
-        if compare_twoFA_code(twoFA.key, code):
-            lp.twoFA_verified = True
-            db.session.commit()
-            return send_200("twoFA verified")
-        else:
-            return send_404("invalid twoFA code")
+        code_valid = compare_twoFA_code(twoFA.key, code)
     except:
         return send_404("failed to compare twoFA code")
+    # a token is only ever handed to the window that logged in, with a valid code
+    if lp.twoFA_verified:
+        if not (code_valid and window_id == lp.window_id):
+            return send_200("twoFA already verifyed")
+        data = json.dumps({"token": issue_token(lp), "successMessage": "twoFA already verifyed"})
+        return send_200("", data=data)
+    if not code_valid:
+        return send_404("invalid twoFA code")
+    lp.twoFA_verified = True
+    db.session.commit()
+    if window_id != lp.window_id:
+        return send_200("twoFA verified")
+    data = json.dumps({"token": issue_token(lp), "successMessage": "twoFA verified"})
+    return send_200("", data=data)
 
 
 @app.route("/fc_login", methods=["GET", "POST"])
@@ -416,34 +1282,24 @@ def fc_login():
     if lp.fc_verified:
         return send_200("fc already verifyed")
     try:
-        input_filename = f"./fc_images/{username}_input.png"
-        reference_filename = f"./fc_images/{username}_reference.png"
         _, encoded = picture_data_uri.split(",", 1)
         input_data = b64decode(encoded)
-        with open(input_filename, "wb") as f:
-            f.write(input_data)
-        res = s3_client.get_object(
-            Bucket=config("AWS_BUCKET_NAME"),
-            Key=f"{username}_reference.png",
-        )
-
-        reference_data = res.get("Body", None)
-        if not reference_data:
-            return send_404("could not download reference")
-        with open(reference_filename, "wb") as f:
-            f.write(reference_data.read())
+        reference_encoding = get_reference_encoding(username)
+        if not reference_encoding:
+            return send_404("could not load reference")
 
-        if compare_face_data(input_filename, reference_filename):
+        if compare_face_encoding(input_data, reference_encoding):
             lp.fc_verified = True
             db.session.commit()
-            remove_files([input_filename, reference_filename])
             return send_200("fc verified")
         else:
-            remove_files([input_filename, reference_filename])
             return send_404("invalid fc")
+    except FcPoolBusy:
+        return send_503("face verification busy")
+    except FcPoolTimeout:
+        return send_503("face verification timed out")
     except Exception as e:
         print(e)
-        remove_files([input_filename, reference_filename])
         return send_404("failed to verify fc")
 
 
@@ -523,14 +1379,19 @@ def send_twoFA_code():
     try:
         twoFA = TwoFACode.query.get(username)
         if not twoFA:
-            code_img, key = generate_twoFA_code(username)
-            twoFA = TwoFACode(username=username, key=key)
+            twoFA = TwoFACode(username=username, key=generate_twoFA_key())
             db.session.add(twoFA)
             db.session.commit()
+        uri = twoFA_provisioning_uri(username, twoFA.key)
+        etag = twoFA_code_etag(uri)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
         else:
-            code_img, _ = generate_twoFA_code(username, twoFA.key)
-        img_io = pil_img_to_io(code_img)
-        return send_file(img_io, mimetype="image/png")
+            response = Response(render_twoFA_code(uri), mimetype="image/png")
+        response.set_etag(etag)
+        # the image embeds the totp secret, keep it out of shared caches
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
     except:
         return send_404("2FA code generation failed")
 
@@ -582,17 +1443,23 @@ def face_recognition_setup():
         picture_data = b64decode(encoded)
         # with open("yee.png", "wb") as f:
         #     f.write(picture_data)
-        picture_data = BytesIO(picture_data)
-        picture_data.seek(0)
+        encoding = encode_face(picture_data)
         s3_client.put_object(
             Bucket=config("AWS_BUCKET_NAME"),
             Key=f"{username}_reference.png",
             Body=picture_data
         )
-        fc = FaceRecognition(username=username)
-        db.session.add(fc)
+        fc = FaceRecognition.query.get(username)
+        if not fc:
+            fc = FaceRecognition(username=username)
+            db.session.add(fc)
+        fc.encoding = encoding
         db.session.commit()
         return send_200("picture uploaded")
+    except FcPoolBusy:
+        return send_503("face verification busy")
+    except FcPoolTimeout:
+        return send_503("face verification timed out")
     except:
         return send_404("failed to upload picture")
 
@@ -609,37 +1476,27 @@ def validate_face_recognition():
     if not username or not picture_data_uri:
         return send_404("no credentials found")
     try:
-        input_filename = f"./fc_images/{username}_input.png"
-        reference_filename = f"./fc_images/{username}_reference.png"
         _, encoded = picture_data_uri.split(",", 1)
         input_data = b64decode(encoded)
-        with open(input_filename, "wb") as f:
-            f.write(input_data)
-        res = s3_client.get_object(
-            Bucket=config("AWS_BUCKET_NAME"),
-            Key=f"{username}_reference.png",
-        )
+        reference_encoding = get_reference_encoding(username)
+        if not reference_encoding:
+            return send_404("could not load reference")
 
-        reference_data = res.get("Body", None)
-        if not reference_data:
-            return send_404("could not download reference")
-        with open(reference_filename, "wb") as f:
-            f.write(reference_data.read())
-
-        if compare_face_data(input_filename, reference_filename):
+        if compare_face_encoding(input_data, reference_encoding):
             fc = FaceRecognition.query.get(username)
             if not fc:
                 raise Exception("no fc found")
             fc.verified = True
             db.session.commit()
-            remove_files([input_filename, reference_filename])
             return send_200("input matches reference")
         else:
-            remove_files([input_filename, reference_filename])
             return send_404("input does not match reference")
+    except FcPoolBusy:
+        return send_503("face verification busy")
+    except FcPoolTimeout:
+        return send_503("face verification timed out")
     except Exception as e:
         print(e)
-        remove_files([input_filename, reference_filename])
         return send_404("failed to compare input and reference")
 
 
@@ -670,17 +1527,9 @@ def create_user():
     if user:
         return send_404("user already created")
     try:
-        entry_directory = Directory(username=username, name="entry")
-        db.session.add(entry_directory)
-        db.session.commit()
-        entry_directory = Directory.query.filter_by(username=username).all()
-
-        if len(entry_directory) > 1:
-            for directory in entry_directory[1:]:
-                db.session.delete(directory)
-            db.session.commit()
-
-        entry_directory = entry_directory[0]
+        # entry directory and user are committed together, so a failed
+        # attempt no longer leaves a stray entry directory behind
+        entry_directory = add_directory(None, "entry", username)
         secret = "S4_SECRET_" + pyotp.random_base32()
         user = User(username=username, password=password, security_question=security_question,
                     security_answer=security_answer, secret=secret, entry_directory=entry_directory.id)
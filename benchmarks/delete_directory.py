@@ -0,0 +1,132 @@
+"""delete_directory on a large random tree, set-based vs the old walk.
+
+Run from the repository root:
+
+    python -m benchmarks.delete_directory
+    python -m benchmarks.delete_directory --directories 20000 --files-per-directory 2
+
+Both modes delete the same freshly built tree, backed by SQLite and an
+in-process moto bucket. "legacy" replays the old breadth-first walk, which
+issues one query per directory and leaves files behind. "route" calls
+/delete_directory. The output lists time, SQL statements, and the rows and
+objects left behind.
+"""
+from collections import deque
+import argparse
+import random
+import os
+
+from benchmarks.common import load_app, login, QueryCounter, timed
+
+
+def build_tree(app, root_id, username, directories, files_per_directory, seed):
+    rng = random.Random(seed)
+    bucket = os.environ["AWS_BUCKET_NAME"]
+    with app.app.app_context():
+        next_directory = (app.db.session.query(app.db.func.max(app.Directory.id)).scalar() or 0) + 1
+        next_file = (app.db.session.query(app.db.func.max(app.File.id)).scalar() or 0) + 1
+        ids = [root_id]
+        directory_rows = []
+        file_rows = []
+        for i in range(directories):
+            directory_id = next_directory + i
+            directory_rows.append({"id": directory_id, "parent_id": rng.choice(ids),
+                                   "name": f"d{directory_id}", "username": username})
+            ids.append(directory_id)
+        for directory_id in ids[1:]:
+            for _ in range(files_per_directory):
+                file_rows.append({"id": next_file, "directory_id": directory_id, "username": username,
+                                  "name": f"f{next_file}.txt", "s3_name": f"file-{next_file}.txt",
+                                  "content_type": "text/plain"})
+                next_file += 1
+        app.db.session.bulk_insert_mappings(app.Directory, directory_rows)
+        app.db.session.bulk_insert_mappings(app.File, file_rows)
+        app.db.session.commit()
+        app.rebuild_directory_closure()
+    for row in file_rows:
+        app.s3_client.put_object(Bucket=bucket, Key=row["s3_name"], Body=b"x")
+    return ids[1:]
+
+
+def legacy_delete(app, directory_id):
+    with app.app.app_context():
+        directory = app.Directory.query.get(directory_id)
+        directoriesToDelete = deque([directory])
+        layer = 0
+        while directoriesToDelete:
+            for _ in range(len(directoriesToDelete)):
+                curr = directoriesToDelete.popleft()
+                children = app.Directory.query.filter_by(parent_id=curr.id).all()
+                if children and layer < 10:
+                    directoriesToDelete.extend(children)
+                app.db.session.delete(curr)
+            layer += 1
+        app.db.session.commit()
+
+
+def route_delete(app, session, directory_id):
+    res = app.app.test_client().get("/delete_directory", query_string={
+        "username": session["username"],
+        "windowId": session["windowId"],
+        "directoryName": "top",
+        "directoryId": directory_id,
+    })
+    assert res.status_code == 200, res.data
+
+
+def bucket_keys(app):
+    paginator = app.s3_client.get_paginator("list_objects_v2")
+    return [obj["Key"] for page in paginator.paginate(Bucket=os.environ["AWS_BUCKET_NAME"])
+            for obj in page.get("Contents", [])]
+
+
+def leftovers(app, directory_ids):
+    with app.app.app_context():
+        directories = sum(
+            app.Directory.query.filter(app.Directory.id.in_(directory_ids[i:i + 500])).count()
+            for i in range(0, len(directory_ids), 500))
+        files = app.File.query.count()
+    return directories, files, len(bucket_keys(app))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--directories", type=int, default=10000)
+    parser.add_argument("--files-per-directory", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", choices=["legacy", "route"], default=["legacy", "route"])
+    args = parser.parse_args()
+
+    app = load_app()
+    session = login(app)
+    counter = QueryCounter(app)
+
+    print(f"{'mode':>7} {'nodes':>7} {'seconds':>8} {'queries':>8} {'dirs left':>10} {'files left':>11} {'objects left':>13}")
+    for mode in args.modes:
+        with app.app.app_context():
+            top = app.add_directory(session["entryDirectoryId"], "top", session["username"])
+            app.db.session.commit()
+            top_id = top.id
+        directory_ids = build_tree(app, top_id, session["username"], args.directories,
+                                   args.files_per_directory, args.seed)
+        counter.count = 0
+        if mode == "legacy":
+            elapsed, _ = timed(legacy_delete, app, top_id)
+        else:
+            elapsed, _ = timed(route_delete, app, session, top_id)
+        queries = counter.count
+        directories, files, objects = leftovers(app, directory_ids)
+        nodes = len(directory_ids) * (1 + args.files_per_directory)
+        print(f"{mode:>7} {nodes:>7} {elapsed:>8.2f} {queries:>8} {directories:>10} {files:>11} {objects:>13}")
+        # clear what legacy left behind so the next mode starts from the same state
+        with app.app.app_context():
+            app.File.query.delete()
+            for i in range(0, len(directory_ids), 500):
+                app.Directory.query.filter(app.Directory.id.in_(directory_ids[i:i + 500])).delete(
+                    synchronize_session=False)
+            app.db.session.commit()
+        app.delete_objects(app.s3_client, os.environ["AWS_BUCKET_NAME"], bucket_keys(app))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Face comparison throughput against batch size.
+
+Run from the repository root:
+
+    python -m benchmarks.fc_batch
+    python -m benchmarks.fc_batch --mode pool --clients 32
+
+"direct" calls fc.compare_face_batch in this process. "pool" drives
+fc_batch.compare_face_encoding from concurrent client threads, so frames go
+through the batch window and the face worker pool like they do in fc_login.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_image(name):
+    with open(os.path.join(ROOT, "test_fc_images", name), "rb") as f:
+        return f.read()
+
+
+def bench_direct(sizes, rounds, known, unknown, reference):
+    import fc
+    print(f"{'batch':>6} {'frames/s':>10} {'ms/batch':>10}")
+    for size in sizes:
+        images = [unknown if i % 2 else known for i in range(size)]
+        references = [reference] * size
+        fc.compare_face_batch(images, references)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fc.compare_face_batch(images, references)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>6} {size * rounds / elapsed:>10.1f} {elapsed / rounds * 1000:>10.1f}")
+
+
+def bench_pool(sizes, rounds, clients, known, unknown, reference):
+    import fc_batch
+    import fc_pool
+
+    def verify(image):
+        try:
+            fc_batch.compare_face_encoding(image, reference)
+            return True
+        except fc_pool.FcPoolBusy:
+            return False
+
+    print(f"{'batch':>6} {'clients':>8} {'frames/s':>10} {'rejected':>9}")
+    for size in sizes:
+        fc_batch.FC_BATCH_MAX_SIZE = size
+        frames = [unknown if i % 2 else known for i in range(clients * rounds)]
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(verify, frames[:clients]))
+            start = time.perf_counter()
+            accepted = list(executor.map(verify, frames))
+            elapsed = time.perf_counter() - start
+        print(f"{size:>6} {clients:>8} {sum(accepted) / elapsed:>10.1f} {accepted.count(False):>9}")
+    fc_pool.reset_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["direct", "pool"], default="direct")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    known = read_image("known.png")
+    unknown = read_image("unknown.png")
+    import fc
+    reference = fc.encode_face(known)
+
+    if args.mode == "direct":
+        bench_direct(args.sizes, args.rounds, known, unknown, reference)
+    else:
+        bench_pool(args.sizes, args.rounds, args.clients, known, unknown, reference)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Latency and accuracy of each face detection profile.
+
+Run from the repository root:
+
+    python -m benchmarks.fc_profiles
+    python -m benchmarks.fc_profiles --profiles default fast --rounds 20
+
+For every profile this encodes test_fc_images/known.png and unknown.png and
+reports per-frame encoding latency, the known/unknown distance and match
+decision, and how far each encoding drifts from the "accurate" profile.
+"""
+import argparse
+import time
+import os
+
+import numpy as np
+
+import fc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(name):
+    with open(os.path.join(ROOT, "test_fc_images", name), "rb") as f:
+        return fc.load_image_data(f.read())
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", nargs="+", default=list(fc.DETECTION_PROFILES))
+    parser.add_argument("--baseline", default="accurate")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    images = {"known": load("known.png"), "unknown": load("unknown.png")}
+    baseline_profile = fc.get_detection_profile(args.baseline)
+    baseline = {name: fc.encode_image(img, baseline_profile) for name, img in images.items()}
+
+    print(f"{'profile':>10} {'p50 ms':>8} {'p95 ms':>8} {'distance':>9} {'match':>6} {'drift':>7}")
+    for name in args.profiles:
+        profile = fc.get_detection_profile(name)
+        samples = []
+        encodings = {}
+        for _ in range(args.rounds):
+            for image_name, img in images.items():
+                start = time.perf_counter()
+                encodings[image_name] = fc.encode_image(img, profile)
+                samples.append(time.perf_counter() - start)
+        distance = float(np.linalg.norm(encodings["known"] - encodings["unknown"]))
+        drift = max(float(np.linalg.norm(encodings[n] - baseline[n])) for n in images)
+        print(f"{name:>10} {percentile(samples, 50):>8.1f} {percentile(samples, 95):>8.1f} "
+              f"{distance:>9.3f} {str(distance <= fc.FACE_TOLERANCE):>6} {drift:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
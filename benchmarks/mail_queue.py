@@ -0,0 +1,88 @@
+"""Verification email throughput against a local SMTP sink.
+
+Run from the repository root:
+
+    python -m benchmarks.mail_queue
+    python -m benchmarks.mail_queue --messages 2000 --batch-sizes 1 20 100
+
+An aiosmtpd server on localhost stands in for Gmail. "per-message" replays
+the old behaviour of one connection per email. The other rows go through
+mail_queue.MailWorker with one persistent session and the given batch size.
+Each row reports the time from the first enqueue until the sink has received
+every message.
+"""
+import argparse
+import time
+import os
+
+from aiosmtpd.controller import Controller
+
+from mail_queue import MailWorker
+from send_verification_email import build_verification_email
+
+
+class CountingHandler:
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+def per_message(host, port, messages):
+    import smtplib
+    for message in messages:
+        with smtplib.SMTP(host, port) as smtp:
+            smtp.send_message(message)
+
+
+def wait_for(handler, total, timeout=120):
+    deadline = time.monotonic() + timeout
+    while handler.received < total and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 20, 100])
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+
+    os.environ.setdefault("GOOGLE_APP_USERNAME", "bench@example.com")
+    handler = CountingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=args.port)
+    controller.start()
+    messages = [build_verification_email(f"user{i}@example.com", f"{i % 1000000:06d}")
+                for i in range(args.messages)]
+
+    print(f"{'mode':>12} {'messages':>9} {'seconds':>8} {'msg/s':>8}")
+    try:
+        handler.received = 0
+        start = time.perf_counter()
+        per_message(controller.hostname, controller.port, messages)
+        wait_for(handler, len(messages))
+        elapsed = time.perf_counter() - start
+        print(f"{'per-message':>12} {handler.received:>9} {elapsed:>8.2f} {handler.received / elapsed:>8.1f}")
+
+        for batch_size in args.batch_sizes:
+            handler.received = 0
+            worker = MailWorker(host=controller.hostname, port=controller.port, use_ssl=False,
+                                queue_size=len(messages), batch_size=batch_size)
+            start = time.perf_counter()
+            for message in messages:
+                worker.enqueue(message)
+            enqueued = time.perf_counter() - start
+            worker.join()
+            wait_for(handler, len(messages))
+            elapsed = time.perf_counter() - start
+            worker.stop()
+            print(f"{'batch ' + str(batch_size):>12} {handler.received:>9} {elapsed:>8.2f} "
+                  f"{handler.received / elapsed:>8.1f}  (enqueue {enqueued * 1000:.1f} ms)")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
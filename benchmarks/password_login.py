@@ -0,0 +1,74 @@
+"""password_login throughput under concurrent load.
+
+Run from the repository root:
+
+    python -m benchmarks.password_login
+    python -m benchmarks.password_login --clients 64 --requests 1000 --workers 0 4
+
+Every client thread logs in as one of --users accounts through the Flask
+test client. --workers 0 checks bcrypt inline on the request thread, which
+is the old behaviour. Other values use password_hashing's bounded pool.
+Admission limits come from the LOGIN_* settings. Throttled (429) and busy
+(503) responses are counted, not retried.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import argparse
+import time
+
+import bcrypt
+import numpy as np
+
+from benchmarks.common import load_app, login
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=None, help="bcrypt cost, defaults to BCRYPT_ROUNDS")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    args = parser.parse_args()
+
+    app = load_app()
+    import password_hashing
+    rounds = args.rounds or password_hashing.BCRYPT_ROUNDS
+    password_hashing.BCRYPT_ROUNDS = rounds
+    hashed = bcrypt.hashpw(b"bench-password", bcrypt.gensalt(rounds)).decode("utf8")
+    usernames = [f"bench{i}" for i in range(args.users)]
+    for username in usernames:
+        login(app, username)
+    with app.app.app_context():
+        app.User.query.filter(app.User.username.in_(usernames)).update(
+            {app.User.password: hashed}, synchronize_session=False)
+        app.db.session.commit()
+
+    def attempt(i):
+        username = usernames[i % len(usernames)]
+        start = time.perf_counter()
+        res = app.app.test_client().get("/password_login", query_string={
+            "username": username, "password": "bench-password", "windowId": "bench-window"})
+        return res.status_code, time.perf_counter() - start
+
+    print(f"cost {rounds}, {args.clients} clients, {args.requests} requests")
+    print(f"{'workers':>8} {'ok/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'429':>6} {'503':>6}")
+    for workers in args.workers:
+        password_hashing.reset_executor()
+        password_hashing.BCRYPT_WORKERS = workers
+        # admission limits are per process, start every run from full buckets
+        password_hashing._user_buckets.clear()
+        password_hashing._global_bucket.tokens = password_hashing._global_bucket.capacity
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            start = time.perf_counter()
+            results = list(executor.map(attempt, range(args.requests)))
+            elapsed = time.perf_counter() - start
+        statuses = Counter(status for status, _ in results)
+        latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+        print(f"{workers:>8} {statuses[200] / elapsed:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} "
+              f"{statuses[429]:>6} {statuses[503]:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""Per-route throughput and latency for realistic client sessions.
+
+Run from the repository root:
+
+    python -m benchmarks.routes
+    python -m benchmarks.routes --users 16 --iterations 20 --json results.json
+    python -m benchmarks.routes --baseline results.json --tolerance 0.2
+
+The app runs in this process against a throwaway SQLite database, an
+in-process moto bucket and an aiosmtpd sink on localhost. Client threads,
+one per user, go through these phases in order:
+
+    signup    send_verification (code read back from the sink),
+              validate_verification, send_twoFA_code, validate_twoFA_code,
+              face_recognition_setup, create_user
+    login     password_login, twoFA_login, fc_login
+    session   get_entry_directory, create_directory, create_file and
+              create_files for each --sizes, get_directory (tree and paged),
+              get_directory_path, search, get_file (full, range,
+              revalidated), get_directory_zip, delete_file, delete_files
+    faces     validate_face_recognition with test_fc_images/known.png
+
+Face routes are skipped with --no-faces. Every route reports requests, errors
+(status >= 400), requests per second over its phase, and p50/p95/p99 in ms.
+--json writes the same numbers. --baseline compares p95 per route with an
+earlier --json file and exits with status 1 when a route got slower than
+--tolerance allows.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from base64 import b64encode
+from io import BytesIO
+import threading
+import argparse
+import platform
+import random
+import json
+import time
+import sys
+import os
+
+import numpy as np
+
+from benchmarks.common import BENCH_ENV, load_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.phases = {}
+        self.route_phase = {}
+
+    def record(self, phase, route, latency, ok):
+        with self.lock:
+            self.samples[route].append((latency, ok))
+            self.route_phase[route] = phase
+
+    def summary(self):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = np.array([latency for latency, ok in samples if ok]) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+            elapsed = self.phases.get(self.route_phase[route], 0)
+            routes[route] = {
+                "phase": self.route_phase[route],
+                "requests": len(samples),
+                "errors": sum(1 for _, ok in samples if not ok),
+                "rps": round(len(samples) / elapsed, 2) if elapsed else 0,
+                "p50": round(float(p50), 2),
+                "p95": round(float(p95), 2),
+                "p99": round(float(p99), 2),
+            }
+        return routes
+
+
+class CodeSink:
+    # aiosmtpd handler keeping the last verification code sent to each address
+    def __init__(self):
+        self.codes = {}
+        self.received = threading.Condition()
+
+    async def handle_DATA(self, server, session, envelope):
+        body = envelope.content.decode("utf8", "replace")
+        code = body.rsplit("Your verification code is ", 1)[-1].strip()[:6]
+        with self.received:
+            for address in envelope.rcpt_tos:
+                self.codes[address] = code
+            self.received.notify_all()
+        return "250 OK"
+
+    def wait_for(self, address, timeout=30):
+        with self.received:
+            self.received.wait_for(lambda: address in self.codes, timeout=timeout)
+            return self.codes.pop(address, None)
+
+
+class Client:
+    def __init__(self, app, recorder, username, password_hash, faces):
+        self.app = app
+        self.http = app.app.test_client()
+        self.recorder = recorder
+        self.username = username
+        self.password_hash = password_hash
+        self.faces = faces
+        self.window_id = None
+        self.token = None
+        self.entry_directory_id = None
+        self.phase = None
+
+    def call(self, route, method="get", label=None, **kwargs):
+        # label tells variants of one route apart, e.g. "/get_file range"
+        start = time.perf_counter()
+        res = getattr(self.http, method)(route, **kwargs)
+        # streamed bodies count until the last byte
+        data = res.get_data()
+        latency = time.perf_counter() - start
+        self.recorder.record(self.phase, label or route, latency, res.status_code < 400)
+        if res.status_code >= 400 and os.environ.get("BENCH_VERBOSE", None):
+            print(label or route, res.status_code, data[:200])
+        return res, data
+
+    def credentials(self, **extra):
+        return dict(username=self.username, windowId=self.window_id, **extra)
+
+    def totp(self):
+        import pyotp
+        with self.app.app.app_context():
+            key = self.app.TwoFACode.query.get(self.username).key
+        return pyotp.TOTP(key).now()
+
+    def signup(self, sink):
+        self.call("/send_verification", query_string={"username": self.username})
+        code = sink.wait_for(self.username)
+        self.call("/validate_verification", query_string={"username": self.username, "code": code})
+        self.call("/send_twoFA_code", query_string={"username": self.username})
+        self.call("/validate_twoFA_code", query_string={"username": self.username, "code": self.totp()})
+        if self.faces:
+            self.call("/face_recognition_setup", method="post",
+                      data=json.dumps({"data": {"username": self.username, "pictureData": self.faces["known"]}}))
+        self.call("/create_user", query_string={
+            "username": self.username, "password": self.password_hash,
+            "securityQuestion": "q", "securityAnswer": "a"})
+
+    def login(self, password):
+        self.window_id = f"window-{random.getrandbits(32):08x}"
+        self.call("/password_login", query_string=self.credentials(password=password))
+        res, data = self.call("/twoFA_login", query_string=self.credentials(code=self.totp()))
+        if res.status_code == 200:
+            self.token = json.loads(data)["token"]
+        if self.faces:
+            self.call("/fc_login", method="post",
+                      data=json.dumps({"data": self.credentials(pictureData=self.faces["known"])}))
+
+    def upload(self, directory_id, name, body):
+        data = self.credentials(fileName=name, directoryId=directory_id, contentType="application/octet-stream",
+                                token=self.token)
+        res, data = self.call("/create_file", method="post", data={
+            "file": (BytesIO(body), name), "data": (BytesIO(json.dumps(data).encode("utf8")), "data.json")})
+        return json.loads(data) if res.status_code == 200 else None
+
+    def session(self, rng, sizes, batch_size):
+        res, data = self.call("/get_entry_directory", query_string=self.credentials())
+        if res.status_code != 200:
+            return
+        root = int(json.loads(data)["entryDirectoryId"])
+        res, data = self.call("/create_directory", query_string=self.credentials(
+            parentDirectoryId=root, directoryName=f"folder {rng.getrandbits(32):08x}"))
+        directory_id = json.loads(data)["id"] if res.status_code == 200 else root
+
+        files = [self.upload(directory_id, f"upload-{size}.bin", os.urandom(size)) for size in sizes]
+        files = [file for file in files if file]
+        names = [f"batch-{i}.bin" for i in range(batch_size)]
+        data = self.credentials(directoryId=directory_id, token=self.token,
+                                files=[{"fileName": name, "contentType": "application/octet-stream"} for name in names])
+        res, body = self.call("/create_files", method="post", data={
+            "data": (BytesIO(json.dumps(data).encode("utf8")), "data.json"),
+            "file": [(BytesIO(os.urandom(sizes[0])), name) for name in names]})
+        batch = [result["file"] for result in json.loads(body)["results"] if "file" in result] \
+            if res.status_code == 200 else []
+
+        res, _ = self.call("/get_directory", query_string=self.credentials(directoryId=root, depth=2))
+        etag = res.headers.get("ETag", None)
+        if etag:
+            self.call("/get_directory", label="/get_directory 304", headers={"If-None-Match": etag},
+                      query_string=self.credentials(directoryId=root, depth=2))
+        self.call("/get_directory", label="/get_directory paged",
+                  query_string=self.credentials(directoryId=directory_id, pageSize=20))
+        self.call("/get_directory_path", query_string=self.credentials(directoryId=directory_id))
+        self.call("/search", query_string=self.credentials(query="upload"))
+
+        for file in files:
+            query = self.credentials(fileId=file["id"], fileName=file["name"], fileS3Name=file["s3Name"])
+            res, _ = self.call("/get_file", query_string=query)
+            self.call("/get_file", label="/get_file range", query_string=query, headers={"Range": "bytes=0-1023"})
+            if res.headers.get("ETag", None):
+                self.call("/get_file", label="/get_file 304", query_string=query,
+                          headers={"If-None-Match": res.headers["ETag"]})
+        self.call("/get_directory_zip", query_string=self.credentials(directoryId=directory_id))
+
+        for file in files:
+            self.call("/delete_file", query_string=self.credentials(
+                fileId=file["id"], fileName=file["name"], fileS3Name=file["s3Name"]))
+        if batch:
+            self.call("/delete_files", query_string=self.credentials(
+                fileIds=",".join(str(file["id"]) for file in batch)))
+        self.call("/delete_directory", query_string=self.credentials(
+            directoryId=directory_id, directoryName="folder"))
+
+    def verify_face(self):
+        self.call("/validate_face_recognition", method="post",
+                  data=json.dumps({"data": {"username": self.username, "pictureData": self.faces["known"]}}))
+
+
+def run_phase(recorder, name, clients, fn):
+    for client in clients:
+        client.phase = name
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        start = time.perf_counter()
+        for future in [executor.submit(fn, client) for client in clients]:
+            future.result()
+        recorder.phases[name] = time.perf_counter() - start
+
+
+def read_face(name):
+    with open(os.path.join(ROOT, "test_fc_images", name), "rb") as f:
+        return "data:image/png;base64," + b64encode(f.read()).decode("ascii")
+
+
+def compare(routes, baseline, tolerance):
+    regressions = []
+    for route, result in routes.items():
+        before = baseline.get("routes", {}).get(route, None)
+        if before and before["p95"] and result["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {before['p95']:.1f} -> {result['p95']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=5, help="session rounds per user")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 256 * 1024, 4 * 1024 * 1024])
+    parser.add_argument("--batch-size", type=int, default=10, help="files per create_files request")
+    parser.add_argument("--face-requests", type=int, default=4, help="validate_face_recognition calls per user")
+    parser.add_argument("--no-faces", action="store_true")
+    parser.add_argument("--smtp-port", type=int, default=8026)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="write results to this file")
+    parser.add_argument("--baseline", default=None, help="compare p95 against an earlier --json file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    from aiosmtpd.controller import Controller
+    sink = CodeSink()
+    controller = Controller(sink, hostname="127.0.0.1", port=args.smtp_port)
+    controller.start()
+    os.environ.update({"SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(args.smtp_port), "SMTP_SSL": "False",
+                       "SMTP_AUTH": "False"})
+    # the suite measures routes, not the login throttle
+    os.environ.setdefault("LOGIN_RATE_PER_USER", "1000")
+    os.environ.setdefault("LOGIN_BURST_PER_USER", "1000")
+    os.environ.setdefault("LOGIN_RATE_GLOBAL", "100000")
+    os.environ.setdefault("LOGIN_BURST_GLOBAL", "100000")
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+    try:
+        app = load_app()
+        import bcrypt
+        import password_hashing
+        password = "bench-password"
+        password_hash = bcrypt.hashpw(password.encode("utf8"),
+                                      bcrypt.gensalt(password_hashing.BCRYPT_ROUNDS)).decode("utf8")
+        faces = None if args.no_faces else {"known": read_face("known.png")}
+        recorder = Recorder()
+        clients = [Client(app, recorder, f"bench{i}@example.com", password_hash, faces) for i in range(args.users)]
+        rng = random.Random(args.seed)
+        seeds = {client.username: rng.getrandbits(32) for client in clients}
+
+        run_phase(recorder, "signup", clients, lambda client: client.signup(sink))
+        run_phase(recorder, "login", clients, lambda client: client.login(password))
+
+        def sessions(client):
+            client_rng = random.Random(seeds[client.username])
+            for _ in range(args.iterations):
+                client.session(client_rng, args.sizes, args.batch_size)
+        run_phase(recorder, "session", clients, sessions)
+        if faces:
+            def verify(client):
+                for _ in range(args.face_requests):
+                    client.verify_face()
+            run_phase(recorder, "faces", clients, verify)
+    finally:
+        controller.stop()
+
+    routes = recorder.summary()
+    print(f"{args.users} users, {args.iterations} session rounds, sizes {args.sizes}")
+    print(f"{'route':>28} {'phase':>8} {'req':>6} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, result in routes.items():
+        print(f"{route:>28} {result['phase']:>8} {result['requests']:>6} {result['errors']:>5} {result['rps']:>8.1f} "
+              f"{result['p50']:>8.1f} {result['p95']:>8.1f} {result['p99']:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "meta": {"users": args.users, "iterations": args.iterations, "sizes": args.sizes,
+                         "batchSize": args.batch_size, "faces": not args.no_faces, "seed": args.seed,
+                         "python": platform.python_version(), "machine": platform.machine(),
+                         "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+                "phases": {name: round(elapsed, 3) for name, elapsed in recorder.phases.items()},
+                "routes": routes
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(routes, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
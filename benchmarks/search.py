@@ -0,0 +1,123 @@
+"""/search latency for a user with a large tree, trigram index vs LIKE scan.
+
+Run from the repository root:
+
+    python -m benchmarks.search
+    python -m benchmarks.search --files 200000 --directories 5000 --queries 500
+
+One user gets --directories random directories and --files files named from
+a small vocabulary, inserted in bulk and indexed with rebuild_search_index.
+"index" runs search_names for directories and files. "scan" runs the LIKE
+queries a search without the index would need. "route" is the whole /search
+request through the Flask test client, including session validation, full
+paths and JSON. Rows are SQLite, no S3 objects are created.
+"""
+from datetime import datetime
+import argparse
+import random
+import time
+
+import numpy as np
+
+from benchmarks.common import load_app, login, timed
+
+WORDS = ["report", "invoice", "holiday", "photo", "scan", "draft", "final", "budget", "notes", "meeting",
+         "design", "backup", "resume", "contract", "receipt", "summary", "plan", "review", "slides", "data"]
+EXTENSIONS = ["txt", "pdf", "png", "jpg", "docx", "csv"]
+
+
+def build_tree(app, root_id, username, directories, files, seed):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    with app.app.app_context():
+        next_directory = (app.db.session.query(app.db.func.max(app.Directory.id)).scalar() or 0) + 1
+        ids = [root_id]
+        rows = []
+        for i in range(directories):
+            directory_id = next_directory + i
+            rows.append({"id": directory_id, "parent_id": rng.choice(ids), "name": f"{rng.choice(WORDS)}s {i}",
+                         "username": username, "date_created": now, "version": 0})
+            ids.append(directory_id)
+        app.db.session.bulk_insert_mappings(app.Directory, rows)
+        rows = []
+        for i in range(files):
+            name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{rng.randint(1, 9999)}.{rng.choice(EXTENSIONS)}"
+            rows.append({"directory_id": rng.choice(ids), "username": username, "name": name,
+                         "s3_name": f"file-{i}", "content_type": "text/plain", "date_created": now})
+            if len(rows) >= 10000:
+                app.db.session.bulk_insert_mappings(app.File, rows)
+                rows = []
+        app.db.session.bulk_insert_mappings(app.File, rows)
+        app.db.session.commit()
+        app.rebuild_directory_closure()
+        app.rebuild_search_index()
+
+
+def index(app, username, query, prefix, limit):
+    with app.app.app_context():
+        directories = app.search_names(username, app.Directory, "d", query, prefix, limit)
+        files = app.search_names(username, app.File, "f", query, prefix, limit)
+    return len(directories) + len(files)
+
+
+def scan(app, username, query, prefix, limit):
+    pattern = f"{query}%" if prefix else f"%{query}%"
+    with app.app.app_context():
+        directories = app.Directory.query.filter(
+            app.Directory.username == username, app.Directory.name.ilike(pattern)).limit(limit).all()
+        files = app.File.query.filter(
+            app.File.username == username, app.File.name.ilike(pattern)).limit(limit).all()
+    return len(directories) + len(files)
+
+
+def route(client, session, query, prefix, limit):
+    res = client.get("/search", query_string={
+        "username": session["username"], "windowId": session["windowId"], "query": query,
+        "mode": "prefix" if prefix else "substring", "limit": limit})
+    data = res.get_json()
+    return len(data["files"]) + len(data["directories"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--directories", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = load_app()
+    session = login(app)
+    elapsed, _ = timed(build_tree, app, session["entryDirectoryId"], session["username"],
+                       args.directories, args.files, args.seed)
+    with app.app.app_context():
+        postings = app.SearchTrigram.query.count()
+    print(f"{args.files} files, {args.directories} directories, {postings} postings, built in {elapsed:.1f}s")
+
+    rng = random.Random(args.seed + 1)
+    workloads = {
+        # rare substrings (a word pair) and common ones (a single word)
+        "substring rare": [f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{rng.randint(1, 99)}" for _ in range(args.queries)],
+        "substring common": [rng.choice(WORDS)[1:] for _ in range(args.queries)],
+        "prefix": [rng.choice(WORDS)[:rng.randint(2, 5)] for _ in range(args.queries)],
+    }
+    client = app.app.test_client()
+    print(f"{'workload':>17} {'mode':>6} {'p50 ms':>8} {'p95 ms':>8} {'hits':>6}")
+    for workload, queries in workloads.items():
+        prefix = workload == "prefix"
+        for mode in ("index", "scan", "route"):
+            latencies, hits = [], 0
+            for query in queries:
+                start = time.perf_counter()
+                if mode == "route":
+                    hits += route(client, session, query, prefix, args.limit)
+                else:
+                    hits += (index if mode == "index" else scan)(app, session["username"], query, prefix, args.limit)
+                latencies.append(time.perf_counter() - start)
+            p50, p95 = np.percentile(np.array(latencies) * 1000, [50, 95])
+            print(f"{workload:>17} {mode:>6} {p50:>8.1f} {p95:>8.1f} {hits / len(queries):>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""File routes under concurrent load, sync vs async gunicorn workers.
+
+Run from the repository root:
+
+    python -m benchmarks.serving_modes
+    python -m benchmarks.serving_modes --clients 500 --requests 5000 --s3-latency 50
+
+A moto server stands in for S3, behind a TCP proxy that adds --s3-latency ms
+to every request so S3 calls cost what they cost over a network. For each
+mode one gunicorn worker serves the app (S4_SERVING_MODE, see
+gunicorn.conf.py). Client threads then hit get_file and get_directory, and
+with --writes also create_file followed by delete_file.
+
+SQLite holds its file lock for a whole write transaction. Under gevent that
+blocks the other greenlets too, so --writes needs --database-url pointing at
+MySQL.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from io import BytesIO
+import subprocess
+import threading
+import argparse
+import tempfile
+import logging
+import socket
+import random
+import time
+import json
+import os
+
+import numpy as np
+import requests
+
+from benchmarks.common import BENCH_ENV, load_app, login
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LatencyProxy:
+    def __init__(self, upstream_port, latency):
+        self.upstream_port = upstream_port
+        self.latency = latency
+        self.listener = socket.create_server(("127.0.0.1", 0), backlog=4096)
+        self.port = self.listener.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", self.upstream_port))
+            threading.Thread(target=self.pipe, args=(client, upstream, True), daemon=True).start()
+            threading.Thread(target=self.pipe, args=(upstream, client, False), daemon=True).start()
+
+    def pipe(self, source, destination, delay):
+        try:
+            while True:
+                chunk = source.recv(65536)
+                if not chunk:
+                    break
+                if delay:
+                    time.sleep(self.latency)
+                destination.sendall(chunk)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def prepare(app, files, file_size):
+    session = login(app)
+    client = app.app.test_client()
+    uploaded = []
+    for i in range(files):
+        data = {key: session[key] for key in ("username", "windowId")}
+        data.update({"fileName": f"bench{i}.bin", "directoryId": session["entryDirectoryId"],
+                     "contentType": "application/octet-stream"})
+        res = client.post("/create_file", data={
+            "file": (BytesIO(os.urandom(file_size)), f"bench{i}.bin"),
+            "data": (BytesIO(json.dumps(data).encode("utf8")), "data.json")})
+        uploaded.append(res.get_json())
+    return session, uploaded
+
+
+def start_server(mode, port, env):
+    env = dict(env, S4_SERVING_MODE=mode)
+    process = subprocess.Popen(
+        ["gunicorn", "--workers", "1", "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"],
+        env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/get_entry_directory", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({mode}) did not start")
+
+
+def run_load(base_url, session, files, file_size, clients, total, writes, seed):
+    rng = random.Random(seed)
+    plan = []
+    for _ in range(total):
+        roll = rng.random()
+        if writes and roll < 0.2:
+            plan.append(("create_file+delete_file", None))
+        elif roll < 0.4:
+            plan.append(("get_directory", None))
+        else:
+            plan.append(("get_file", rng.choice(files)))
+    local = threading.local()
+    credentials = {"username": session["username"], "windowId": session["windowId"]}
+
+    def http():
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        return local.http
+
+    def request(op):
+        route, file = op
+        start = time.perf_counter()
+        if route == "get_file":
+            res = http().get(f"{base_url}/get_file", params=dict(
+                credentials, fileId=file["id"], fileName=file["name"], fileS3Name=file["s3Name"]))
+            ok = res.status_code == 200 and len(res.content) == file_size
+        elif route == "get_directory":
+            res = http().get(f"{base_url}/get_directory", params=dict(
+                credentials, directoryId=session["entryDirectoryId"]))
+            ok = res.status_code == 200
+        else:
+            data = dict(credentials, fileName="upload.bin", directoryId=session["entryDirectoryId"],
+                        contentType="application/octet-stream")
+            res = http().post(f"{base_url}/create_file", files={
+                "file": ("upload.bin", os.urandom(file_size)),
+                "data": ("data.json", json.dumps(data))})
+            ok = res.status_code == 200
+            if ok:
+                created = res.json()
+                res = http().get(f"{base_url}/delete_file", params=dict(
+                    credentials, fileId=created["id"], fileName=created["name"], fileS3Name=created["s3Name"]))
+                ok = res.status_code == 200
+        return route, ok, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(request, plan))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--s3-latency", type=float, default=20, help="ms added to every s3 request")
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"])
+    parser.add_argument("--writes", action="store_true")
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from moto.server import ThreadedMotoServer
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    moto_port = free_port()
+    moto = ThreadedMotoServer(ip_address="127.0.0.1", port=moto_port, verbose=False)
+    moto.start()
+    proxy = LatencyProxy(moto_port, args.s3_latency / 1000)
+    proxy.start()
+
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ["AWS_S3_ENDPOINT_URL"] = f"http://127.0.0.1:{moto_port}"
+    database_url = args.database_url or \
+        "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="s4-bench-"), "bench.db")
+    app = load_app(database_url, mock_s3=False)
+    app.s3_client.create_bucket(Bucket=os.environ["AWS_BUCKET_NAME"])
+    session, files = prepare(app, args.files, args.file_size)
+
+    env = dict(os.environ, AWS_S3_ENDPOINT_URL=f"http://127.0.0.1:{proxy.port}", DATABASE_URL=database_url)
+    print(f"{args.clients} clients, {args.requests} requests, s3 latency {args.s3_latency:.0f} ms, 1 worker")
+    print(f"{'mode':>6} {'route':>24} {'ok':>6} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    try:
+        for mode in args.modes:
+            port = free_port()
+            server = start_server(mode, port, env)
+            try:
+                results, elapsed = run_load(f"http://127.0.0.1:{port}", session, files, args.file_size,
+                                            args.clients, args.requests, args.writes, args.seed)
+            finally:
+                server.terminate()
+                server.wait()
+            errors = Counter(route for route, ok, _ in results if not ok)
+            for route in sorted({route for route, _, _ in results}):
+                latencies = np.array([latency for r, ok, latency in results if r == route and ok]) * 1000
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+                print(f"{mode:>6} {route:>24} {len(latencies):>6} {errors[route]:>5} "
+                      f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f}")
+            ok = sum(1 for _, ok, _ in results if ok)
+            print(f"{mode:>6} {'total req/s':>24} {ok / elapsed:>6.1f}")
+    finally:
+        moto.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from decouple import config
+
+# kept out of fc so web workers can read the resolved profile without loading dlib.
+# detection_width: frames wider than this are downscaled for detection only,
+# the boxes are mapped back and encodings still use the full resolution frame
+DETECTION_PROFILES = {
+    "default": {"detection_width": None, "model": "hog", "upsample": 1, "jitters": 1, "largest_face": False},
+    "accurate": {"detection_width": None, "model": "cnn", "upsample": 1, "jitters": 5, "largest_face": True},
+    "balanced": {"detection_width": 480, "model": "hog", "upsample": 1, "jitters": 1, "largest_face": True},
+    "fast": {"detection_width": 320, "model": "hog", "upsample": 0, "jitters": 1, "largest_face": True},
+}
+
+
+def get_detection_profile(name=None):
+    profile = dict(DETECTION_PROFILES[name or config("FC_DETECTION_PROFILE", default="default")])
+    profile["detection_width"] = config("FC_DETECTION_WIDTH", default=profile["detection_width"],
+                                        cast=lambda v: int(v) if v else None)
+    profile["model"] = config("FC_DETECTION_MODEL", default=profile["model"])
+    profile["upsample"] = config("FC_DETECTION_UPSAMPLE", default=profile["upsample"], cast=int)
+    profile["jitters"] = config("FC_ENCODING_JITTERS", default=profile["jitters"], cast=int)
+    profile["largest_face"] = config("FC_LARGEST_FACE", default=profile["largest_face"], cast=bool)
+    return profile
+
+
+DETECTION_PROFILE = get_detection_profile()
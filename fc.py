@@ -1,11 +1,117 @@
+from io import BytesIO
 import face_recognition
+import numpy as np
+import PIL.Image
 
-def compare_face_data(filename1, filename2):
-    img_1 = face_recognition.load_image_file(filename1)
-    img_1_encoding = face_recognition.face_encodings(img_1)[0]
+from detection_profiles import DETECTION_PROFILES, DETECTION_PROFILE, get_detection_profile
 
-    img_2 = face_recognition.load_image_file(filename2)
-    img_2_encoding = face_recognition.face_encodings(img_2)[0]
+ENCODING_DTYPE = np.float32
+FACE_TOLERANCE = 0.6
 
-    results = face_recognition.compare_faces([img_1_encoding], img_2_encoding)
-    return results[0]
+
+def load_image_data(image_data, mode="RGB"):
+    # accepts raw bytes, a file-like object or a path and decodes in memory
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        image_data = BytesIO(image_data)
+    img = PIL.Image.open(image_data)
+    if mode:
+        img = img.convert(mode)
+    return np.array(img)
+
+
+def downscale_image(img, profile):
+    width = profile["detection_width"]
+    if not width or img.shape[1] <= width:
+        return img, 1.0
+    scale = width / img.shape[1]
+    resized = PIL.Image.fromarray(img).resize((width, max(round(img.shape[0] * scale), 1)))
+    return np.array(resized), scale
+
+
+def scale_face_locations(locations, scale, shape):
+    height, width = shape[:2]
+    scaled = []
+    for top, right, bottom, left in locations:
+        scaled.append((
+            max(round(top / scale), 0),
+            min(round(right / scale), width),
+            min(round(bottom / scale), height),
+            max(round(left / scale), 0)
+        ))
+    return scaled
+
+
+def pick_face_locations(locations, profile):
+    if profile["largest_face"] and len(locations) > 1:
+        return [max(locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))]
+    return locations[:1]
+
+
+def locate_faces(images, profile):
+    downscaled = [downscale_image(img, profile) for img in images]
+    small_images = [small for small, _ in downscaled]
+    # cnn detection can run on a whole batch at once when the frames share a shape
+    if profile["model"] == "cnn" and len(set(img.shape for img in small_images)) == 1:
+        face_locations = face_recognition.batch_face_locations(
+            small_images, number_of_times_to_upsample=profile["upsample"], batch_size=len(small_images))
+    else:
+        face_locations = [
+            face_recognition.face_locations(
+                img, number_of_times_to_upsample=profile["upsample"], model=profile["model"])
+            for img in small_images
+        ]
+    return [
+        pick_face_locations(scale_face_locations(locations, scale, img.shape), profile)
+        for img, (_, scale), locations in zip(images, downscaled, face_locations)
+    ]
+
+
+def encode_faces(images, profile=None):
+    profile = profile or DETECTION_PROFILE
+    encodings = []
+    for img, locations in zip(images, locate_faces(images, profile)):
+        if not locations:
+            encodings.append(None)
+            continue
+        encodings.append(face_recognition.face_encodings(
+            img, known_face_locations=locations, num_jitters=profile["jitters"])[0])
+    return encodings
+
+
+def encode_image(img, profile=None):
+    encoding = encode_faces([img], profile)[0]
+    if encoding is None:
+        raise Exception("no face found")
+    return encoding
+
+
+def encode_face(image_data, profile=None):
+    img_encoding = encode_image(load_image_data(image_data), profile)
+    return img_encoding.astype(ENCODING_DTYPE).tobytes()
+
+
+def decode_face_encoding(encoding):
+    return np.frombuffer(encoding, dtype=ENCODING_DTYPE)
+
+
+def compare_face_encoding(image_data, reference_encoding, profile=None):
+    img_encoding = encode_image(load_image_data(image_data), profile)
+
+    reference = decode_face_encoding(reference_encoding)
+    return bool(np.linalg.norm(img_encoding - reference) <= FACE_TOLERANCE)
+
+
+def compare_face_batch(images_data, reference_encodings, tolerance=FACE_TOLERANCE, profile=None):
+    images = [load_image_data(image_data) for image_data in images_data]
+    encodings = encode_faces(images, profile)
+
+    # frames without a face stay None so their callers can fail individually
+    results = [None] * len(images)
+    found = [i for i, encoding in enumerate(encodings) if encoding is not None]
+    if found:
+        inputs = np.stack([encodings[i] for i in found])
+        references = np.stack([decode_face_encoding(reference_encodings[i]) for i in found])
+        distances = np.linalg.norm(inputs - references, axis=1)
+        for i, distance in zip(found, distances):
+            results[i] = bool(distance <= tolerance)
+    return results
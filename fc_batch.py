@@ -0,0 +1,114 @@
+from concurrent.futures import Future, InvalidStateError
+from decouple import config
+import threading
+import queue
+import time
+import os
+
+import fc_pool
+from detection_profiles import DETECTION_PROFILE
+from fc_pool import FcPoolBusy, FcPoolTimeout
+import metrics
+
+# frames arriving within the window are encoded and compared in one pool job.
+# only cnn detection runs a batch through dlib in one pass, hog detects frame
+# by frame, so a hog batch would only queue frames behind each other in one
+# pool worker while the others idle. batching is off unless the model is cnn
+FC_BATCH_WINDOW_MS = config("FC_BATCH_WINDOW_MS", default=10.0, cast=float)
+FC_BATCH_MAX_SIZE = config("FC_BATCH_MAX_SIZE", default=8 if DETECTION_PROFILE["model"] == "cnn" else 1, cast=int)
+FC_BATCH_QUEUE_SIZE = config("FC_BATCH_QUEUE_SIZE", default=64, cast=int)
+
+_lock = threading.Lock()
+_queue = None
+_queue_pid = None
+
+
+def _get_queue():
+    global _queue, _queue_pid
+    with _lock:
+        # the collector thread does not survive a fork, start one per process
+        if _queue is None or _queue_pid != os.getpid():
+            _queue = queue.Queue(maxsize=FC_BATCH_QUEUE_SIZE)
+            _queue_pid = os.getpid()
+            threading.Thread(target=_collect, args=(_queue,), daemon=True).start()
+        return _queue
+
+
+def _collect(jobs):
+    while True:
+        batch = [jobs.get()]
+        deadline = time.monotonic() + FC_BATCH_WINDOW_MS / 1000
+        while len(batch) < FC_BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _dispatch(batch)
+
+
+def _dispatch(batch):
+    images_data = [image_data for image_data, _, _ in batch]
+    reference_encodings = [reference_encoding for _, reference_encoding, _ in batch]
+    futures = [future for _, _, future in batch]
+    if fc_pool.FC_POOL_WORKERS <= 0:
+        pool_future = Future()
+        try:
+            pool_future.set_result(fc_pool.run("compare_face_batch", images_data, reference_encodings))
+        except Exception as e:
+            pool_future.set_exception(e)
+    else:
+        try:
+            pool_future = fc_pool.submit("compare_face_batch", images_data, reference_encodings)
+        except Exception as e:
+            for future in futures:
+                _resolve(future, exception=e)
+            return
+    pool_future.add_done_callback(lambda done: _distribute(done, futures))
+
+
+def _distribute(pool_future, futures):
+    if pool_future.cancelled():
+        for future in futures:
+            _resolve(future, exception=FcPoolTimeout("face batch cancelled"))
+        return
+    exception = pool_future.exception()
+    if exception:
+        for future in futures:
+            _resolve(future, exception=exception)
+        return
+    for future, result in zip(futures, pool_future.result()):
+        if result is None:
+            _resolve(future, exception=Exception("no face found"))
+        else:
+            _resolve(future, result=result)
+
+
+def _resolve(future, result=None, exception=None):
+    # requests that already timed out have cancelled their future
+    try:
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def compare_face_encoding(image_data, reference_encoding, timeout=None):
+    if FC_BATCH_MAX_SIZE <= 1:
+        return fc_pool.compare_face_encoding(image_data, reference_encoding, timeout=timeout)
+    with metrics.timer("face", "compare_face_batch"):
+        return _compare_batched(image_data, reference_encoding, timeout)
+
+
+def _compare_batched(image_data, reference_encoding, timeout):
+    future = Future()
+    try:
+        _get_queue().put_nowait((image_data, reference_encoding, future))
+    except queue.Full:
+        raise FcPoolBusy("face batch queue full")
+    timeout = (timeout or fc_pool.FC_JOB_TIMEOUT) + FC_BATCH_WINDOW_MS / 1000
+    return fc_pool.wait(future, "compare_face_batch", timeout=timeout)
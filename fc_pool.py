@@ -0,0 +1,104 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from decouple import config
+import multiprocessing
+import threading
+import os
+
+import metrics
+
+# face work runs in separate processes so dlib never blocks a request worker
+FC_POOL_WORKERS = config("FC_POOL_WORKERS", default=2, cast=int)
+FC_POOL_QUEUE_SIZE = config("FC_POOL_QUEUE_SIZE", default=4, cast=int)
+FC_JOB_TIMEOUT = config("FC_JOB_TIMEOUT", default=10.0, cast=float)
+FC_POOL_START_METHOD = config("FC_POOL_START_METHOD", default="spawn")
+
+
+class FcPoolBusy(Exception):
+    pass
+
+
+class FcPoolTimeout(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = threading.BoundedSemaphore(max(FC_POOL_WORKERS, 1) + FC_POOL_QUEUE_SIZE)
+
+
+def _preload():
+    # importing fc loads the dlib detector and encoder models once per worker
+    import fc
+
+
+def _call(name, *args):
+    import fc
+    return getattr(fc, name)(*args)
+
+
+def get_pool():
+    global _pool, _pool_pid
+    with _lock:
+        # pools do not survive a fork, so every gunicorn worker gets its own
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=FC_POOL_WORKERS,
+                mp_context=multiprocessing.get_context(FC_POOL_START_METHOD),
+                initializer=_preload
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def submit(name, *args):
+    if not _slots.acquire(blocking=False):
+        raise FcPoolBusy(f"face pool saturated, {name} rejected")
+    try:
+        future = get_pool().submit(_call, name, *args)
+    except BrokenProcessPool:
+        reset_pool()
+        _slots.release()
+        raise
+    except:
+        _slots.release()
+        raise
+    # the slot is held until the job really finishes, even after a timeout
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def wait(future, name, timeout=None):
+    try:
+        return future.result(timeout=timeout or FC_JOB_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise FcPoolTimeout(f"{name} exceeded {timeout or FC_JOB_TIMEOUT}s")
+    except BrokenProcessPool:
+        reset_pool()
+        raise
+
+
+def run(name, *args, timeout=None):
+    # queueing for a worker included, that is what the request waits for
+    with metrics.timer("face", name):
+        if FC_POOL_WORKERS <= 0:
+            return _call(name, *args)
+        return wait(submit(name, *args), name, timeout=timeout)
+
+
+def encode_face(image_data, timeout=None):
+    return run("encode_face", image_data, timeout=timeout)
+
+
+def compare_face_encoding(image_data, reference_encoding, timeout=None):
+    return run("compare_face_encoding", image_data, reference_encoding, timeout=timeout)
@@ -0,0 +1,11 @@
+# picked up automatically by `gunicorn app:app` (Procfile). gunicorn reads
+# every module level name as a setting, so decouple stays namespaced
+import decouple
+
+S4_SERVING_MODE = decouple.config("S4_SERVING_MODE", default="sync")
+
+if S4_SERVING_MODE == "async":
+    worker_class = "gevent"
+    worker_connections = decouple.config("ASYNC_WORKER_CONNECTIONS", default=2000, cast=int)
+    # long transfers are expected, a busy worker is still heartbeating
+    timeout = decouple.config("ASYNC_WORKER_TIMEOUT", default=120, cast=int)
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from decouple import config
+import threading
+import hashlib
+
+# serialized get_directory bodies keyed by directory and query, each tagged
+# with the directory version it was built from. the version is read from the
+# db on every request, so a stale entry is never served, only replaced
+LISTING_CACHE_SIZE = config("LISTING_CACHE_SIZE", default=1024, cast=int)
+# bodies held per process across all entries, least recently used go first
+LISTING_CACHE_BYTES = config("LISTING_CACHE_BYTES", default=16 * 1024 * 1024, cast=int)
+# huge listings are rebuilt rather than pinned in every worker
+LISTING_CACHE_MAX_BYTES = config("LISTING_CACHE_MAX_BYTES", default=256 * 1024, cast=int)
+
+_lock = threading.Lock()
+_listings = OrderedDict()
+_bytes = 0
+
+
+def listing_etag(directory_id, version, params):
+    query = hashlib.sha256(repr(params).encode("utf8")).hexdigest()[:16]
+    return f"{directory_id}-{version}-{query}"
+
+
+def get_listing(directory_id, version, params):
+    if LISTING_CACHE_SIZE <= 0:
+        return None
+    key = (directory_id, params)
+    with _lock:
+        cached = _listings.get(key, None)
+        if not cached or cached[0] != version:
+            return None
+        _listings.move_to_end(key)
+        return cached[1]
+
+
+def put_listing(directory_id, version, params, body):
+    global _bytes
+    if LISTING_CACHE_SIZE <= 0 or len(body) > min(LISTING_CACHE_MAX_BYTES, LISTING_CACHE_BYTES):
+        return
+    key = (directory_id, params)
+    with _lock:
+        cached = _listings.get(key, None)
+        # a slower request must not replace a listing built from a newer version
+        if cached and cached[0] > version:
+            return
+        if cached:
+            _bytes -= len(cached[1])
+        _listings[key] = (version, body)
+        _listings.move_to_end(key)
+        _bytes += len(body)
+        while len(_listings) > LISTING_CACHE_SIZE or _bytes > LISTING_CACHE_BYTES:
+            _, (_, evicted) = _listings.popitem(last=False)
+            _bytes -= len(evicted)
@@ -0,0 +1,141 @@
+from decouple import config
+import smtplib
+import threading
+import queue
+import time
+import ssl
+import os
+
+import metrics
+
+SMTP_HOST = config("SMTP_HOST", default="smtp.gmail.com")
+SMTP_PORT = config("SMTP_PORT", default=465, cast=int)
+SMTP_SSL = config("SMTP_SSL", default=True, cast=bool)
+SMTP_AUTH = config("SMTP_AUTH", default=True, cast=bool)
+MAIL_QUEUE_SIZE = config("MAIL_QUEUE_SIZE", default=1000, cast=int)
+MAIL_BATCH_SIZE = config("MAIL_BATCH_SIZE", default=20, cast=int)
+MAIL_MAX_RETRIES = config("MAIL_MAX_RETRIES", default=5, cast=int)
+MAIL_RETRY_BACKOFF = config("MAIL_RETRY_BACKOFF", default=0.5, cast=float)
+# the session is dropped after this long without mail and reopened on demand
+MAIL_IDLE_TIMEOUT = config("MAIL_IDLE_TIMEOUT", default=60.0, cast=float)
+
+
+class MailWorker:
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_ssl=SMTP_SSL, username=None, password=None,
+                 queue_size=MAIL_QUEUE_SIZE, batch_size=MAIL_BATCH_SIZE, max_retries=MAIL_MAX_RETRIES,
+                 retry_backoff=MAIL_RETRY_BACKOFF, idle_timeout=MAIL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.smtp = None
+        self.sent = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            raise Exception("mail queue full")
+
+    def join(self):
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def connect(self):
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(self.host, self.port)
+        if self.username:
+            smtp.login(self.username, self.password)
+        self.smtp = smtp
+
+    def disconnect(self):
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+        self.smtp = None
+
+    def run(self):
+        while True:
+            try:
+                message = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            if message is None:
+                self.queue.task_done()
+                self.disconnect()
+                return
+            batch = [message]
+            while len(batch) < self.batch_size:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    # keep the sentinel for the next loop, after this batch
+                    self.queue.task_done()
+                    self.queue.put(None)
+                    break
+                batch.append(message)
+            for message in batch:
+                self.deliver(message)
+                self.queue.task_done()
+
+    def deliver(self, message):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if not self.smtp:
+                    self.connect()
+                with metrics.timer("smtp", "send_message"):
+                    self.smtp.send_message(message)
+                self.sent += 1
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                # retrying will not change the recipient
+                print("send email failed", e)
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                print("send email failed", e)
+                self.disconnect()
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+        self.failed += 1
+
+
+_lock = threading.Lock()
+_worker = None
+_worker_pid = None
+
+
+def get_worker():
+    global _worker, _worker_pid
+    with _lock:
+        # the delivery thread does not survive a fork, start one per process
+        if _worker is None or _worker_pid != os.getpid():
+            username = config("GOOGLE_APP_USERNAME") if SMTP_AUTH else None
+            password = config("GOOGLE_APP_PASSWORD") if SMTP_AUTH else None
+            _worker = MailWorker(username=username, password=password)
+            _worker_pid = os.getpid()
+        return _worker
+
+
+def enqueue(message):
+    get_worker().enqueue(message)
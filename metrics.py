@@ -0,0 +1,301 @@
+from contextlib import contextmanager
+from collections import Counter
+from flask import g, has_request_context, request, Response
+from decouple import config, Csv
+import threading
+import traceback
+import bisect
+import hmac
+import time
+import sys
+
+# per process metrics in the prometheus text format. under gunicorn every
+# worker keeps its own, scrape each worker or run a single one behind /metrics
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+# /metrics and /metrics/profile want "Authorization: Bearer <token>" or
+# ?token=, without METRICS_TOKEN both answer 404. route timings and stack
+# traces with file paths are not for the public
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+# per request breakdowns in a Server-Timing header, for every response when
+# on, otherwise only for requests sending "X-Metrics-Token: <METRICS_TOKEN>"
+METRICS_SERVER_TIMING = config("METRICS_SERVER_TIMING", default=False, cast=bool)
+METRICS_BUCKETS = config("METRICS_BUCKETS", default="0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10",
+                         cast=Csv(float))
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# sampling profiler, 0 leaves it off. every interval the stacks of all
+# threads are folded into counts served by /metrics/profile
+PROFILER_INTERVAL_MS = config("PROFILER_INTERVAL_MS", default=0, cast=float)
+PROFILER_MAX_STACKS = config("PROFILER_MAX_STACKS", default=20000, cast=int)
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = sorted(buckets)
+        self.lock = threading.Lock()
+        # labels -> [bucket counts..., count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels, None)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            # counts are per bucket here and made cumulative on render
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, labels))
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-2]}')
+            lines.append(f"{self.name}_count{{{label_text}}} {values[-2]}")
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-1]:.6f}")
+        return lines
+
+
+class Total:
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.series = Counter()
+
+    def inc(self, *labels):
+        with self.lock:
+            self.series[labels] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            label_text = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, labels))
+            lines.append(f"{self.name}{{{label_text}}} {value}")
+        return lines
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_seconds = Histogram("s4_request_seconds", "Request handling time by route.", ("route", "method"))
+request_phase_seconds = Histogram("s4_request_phase_seconds", "Time per request spent in each phase, by route.",
+                                  ("route", "phase"))
+request_queries = Histogram("s4_request_sql_queries", "SQL statements per request, by route.", ("route",),
+                            buckets=QUERY_COUNT_BUCKETS)
+phase_seconds = Histogram("s4_phase_seconds", "Duration of each timed call, in or outside requests.",
+                          ("phase", "operation"))
+responses_total = Total("s4_responses_total", "Responses by route and status.", ("route", "status"))
+METRICS = [request_seconds, request_phase_seconds, request_queries, phase_seconds, responses_total]
+
+
+def _breakdown():
+    if has_request_context():
+        return g.get("metrics_phases", None)
+    return None
+
+
+def enter():
+    # timers nest, validate_lp runs sql of its own. each open timer collects
+    # the time of the ones inside it so a phase only counts its own share
+    if _breakdown() is not None:
+        g.metrics_nested.append(0.0)
+    return time.perf_counter()
+
+
+def leave(phase, started, operation=""):
+    # every timed call lands in the global histogram, calls made on a request
+    # thread also count towards that request's breakdown
+    seconds = time.perf_counter() - started
+    if not METRICS_ENABLED:
+        return
+    phase_seconds.observe(seconds, phase, operation)
+    breakdown = _breakdown()
+    if breakdown is None or not g.metrics_nested:
+        return
+    nested = g.metrics_nested.pop()
+    if g.metrics_nested:
+        g.metrics_nested[-1] += seconds
+    breakdown[phase] = breakdown.get(phase, 0) + max(seconds - nested, 0)
+    if phase == "sql":
+        g.metrics_queries += 1
+
+
+@contextmanager
+def timer(phase, operation=""):
+    started = enter()
+    try:
+        yield
+    finally:
+        leave(phase, started, operation)
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(enter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("metrics_started", None)
+        if started:
+            # the first word is enough to tell reads from writes
+            leave("sql", started.pop(), statement.split(None, 1)[0].lower())
+
+    def failed(context):
+        started = context.connection.info.get("metrics_started", None) if context.connection else None
+        if started:
+            leave("sql", started.pop(), "error")
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    event.listen(engine, "handle_error", failed)
+
+
+def instrument_boto_client(client, phase="s3"):
+    # api calls only, streaming a body after get_object returns is not included
+    def before(model, context, **kwargs):
+        context["metrics_started"] = enter()
+        context["metrics_operation"] = model.name
+
+    def after(model, context, **kwargs):
+        started = context.pop("metrics_started", None)
+        if started is not None:
+            leave(phase, started, model.name)
+
+    def failed(context, exception=None, **kwargs):
+        # transport errors come without the operation model, and a handler
+        # that raised here would replace the error botocore is reporting
+        started = context.pop("metrics_started", None)
+        if started is not None:
+            leave(phase, started, context.get("metrics_operation", "error"))
+
+    client.meta.events.register("before-call", before)
+    client.meta.events.register("after-call", after)
+    client.meta.events.register("after-call-error", failed)
+
+
+def token_matches(token):
+    if not METRICS_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf8"), METRICS_TOKEN.encode("utf8"))
+
+
+def route_name():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def init_app(app, engine_getter):
+    @app.before_request
+    def start_request():
+        if METRICS_ENABLED:
+            g.metrics_started = time.perf_counter()
+            g.metrics_phases = {}
+            g.metrics_nested = []
+            g.metrics_queries = 0
+
+    @app.after_request
+    def finish_request(response):
+        started = g.get("metrics_started", None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = route_name()
+        phases = g.metrics_phases
+        request_seconds.observe(elapsed, route, request.method)
+        request_queries.observe(g.metrics_queries, route)
+        responses_total.inc(route, response.status_code)
+        for phase, seconds in phases.items():
+            request_phase_seconds.observe(seconds, route, phase)
+        # whatever no timer claimed is the route's own python
+        request_phase_seconds.observe(max(elapsed - sum(phases.values()), 0), route, "app")
+        if METRICS_SERVER_TIMING or token_matches(request.headers.get("X-Metrics-Token", "")):
+            timing = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in phases.items()]
+            timing.append(f"total;dur={elapsed * 1000:.1f}")
+            response.headers["Server-Timing"] = ", ".join(timing)
+        return response
+
+    with app.app_context():
+        instrument_engine(engine_getter())
+
+    def authorized():
+        auth = request.headers.get("Authorization", "")
+        return token_matches(auth[len("Bearer "):] if auth.startswith("Bearer ") else request.args.get("token", ""))
+
+    @app.route("/metrics")
+    def metrics():
+        if not authorized():
+            return Response(status=404)
+        lines = []
+        for metric in METRICS:
+            lines.extend(metric.render())
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+    @app.route("/metrics/profile")
+    def metrics_profile():
+        if not authorized() or not _sampler:
+            return Response(status=404)
+        # folded stacks, "frame;frame;frame count", ready for flamegraph.pl
+        stacks = _sampler.snapshot(reset=request.args.get("reset", None) == "true")
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return Response("\n".join(lines) + "\n", mimetype="text/plain")
+
+    if PROFILER_INTERVAL_MS > 0:
+        if not METRICS_TOKEN:
+            raise ValueError("PROFILER_INTERVAL_MS needs METRICS_TOKEN, the profile would be unreachable")
+        start_sampler(PROFILER_INTERVAL_MS / 1000)
+
+
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own:
+                        continue
+                    stack = ";".join(f"{entry.name} ({entry.filename}:{entry.lineno})"
+                                     for entry in traceback.extract_stack(frame))
+                    if stack in self.stacks or len(self.stacks) < PROFILER_MAX_STACKS:
+                        self.stacks[stack] += 1
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            stacks = Counter(self.stacks)
+            if reset:
+                self.stacks.clear()
+        return stacks
+
+
+_sampler = None
+
+
+def start_sampler(interval):
+    global _sampler
+    if _sampler is None:
+        _sampler = Sampler(interval)
+    return _sampler
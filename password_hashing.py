@@ -0,0 +1,137 @@
+from concurrent.futures import TimeoutError
+from decouple import config
+import threading
+import bcrypt
+import time
+import os
+
+from serving import cpu_executor
+import metrics
+
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", default=12, cast=int)
+# bcrypt releases the gil, so a small thread pool keeps request workers free
+BCRYPT_WORKERS = config("BCRYPT_WORKERS", default=2, cast=int)
+BCRYPT_QUEUE_SIZE = config("BCRYPT_QUEUE_SIZE", default=8, cast=int)
+BCRYPT_TIMEOUT = config("BCRYPT_TIMEOUT", default=5.0, cast=float)
+
+# token buckets, rate is attempts per second and burst the bucket size
+LOGIN_RATE_GLOBAL = config("LOGIN_RATE_GLOBAL", default=50.0, cast=float)
+LOGIN_BURST_GLOBAL = config("LOGIN_BURST_GLOBAL", default=100, cast=int)
+LOGIN_RATE_PER_USER = config("LOGIN_RATE_PER_USER", default=0.2, cast=float)
+LOGIN_BURST_PER_USER = config("LOGIN_BURST_PER_USER", default=5, cast=int)
+LOGIN_BUCKETS_MAX = config("LOGIN_BUCKETS_MAX", default=100000, cast=int)
+
+
+class LoginThrottled(Exception):
+    pass
+
+
+class PasswordCheckBusy(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        if not self.available(now):
+            return False
+        self.tokens -= 1
+        return True
+
+
+_lock = threading.Lock()
+_global_bucket = TokenBucket(LOGIN_RATE_GLOBAL, LOGIN_BURST_GLOBAL)
+_user_buckets = {}
+
+
+def admit_login(username):
+    now = time.monotonic()
+    with _lock:
+        bucket = _user_buckets.get(username, None)
+        if not bucket:
+            if len(_user_buckets) >= LOGIN_BUCKETS_MAX:
+                # full buckets carry no state worth keeping
+                for key, old in list(_user_buckets.items()):
+                    old.refill(now)
+                    if old.tokens >= old.capacity:
+                        del _user_buckets[key]
+            bucket = _user_buckets[username] = TokenBucket(LOGIN_RATE_PER_USER, LOGIN_BURST_PER_USER)
+        # both are checked before either is charged, a rejected attempt costs nothing
+        if not bucket.available(now):
+            raise LoginThrottled(f"too many attempts for {username}")
+        if not _global_bucket.available(now):
+            raise LoginThrottled("too many login attempts")
+        bucket.take(now)
+        _global_bucket.take(now)
+
+
+_executor = None
+_executor_pid = None
+_slots = None
+
+
+def get_executor():
+    global _executor, _executor_pid, _slots
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = cpu_executor(BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+            _executor_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(BCRYPT_WORKERS + BCRYPT_QUEUE_SIZE)
+        return _executor, _slots
+
+
+def reset_executor():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+def run(fn, *args):
+    if BCRYPT_WORKERS <= 0:
+        return fn(*args)
+    executor, slots = get_executor()
+    if not slots.acquire(blocking=False):
+        raise PasswordCheckBusy("password check pool saturated")
+    try:
+        future = executor.submit(fn, *args)
+    except:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=BCRYPT_TIMEOUT)
+    except TimeoutError:
+        raise PasswordCheckBusy("password check timed out")
+
+
+def check_password(password, hashed):
+    with metrics.timer("bcrypt", "checkpw"):
+        return run(bcrypt.checkpw, password.encode("utf8"), hashed.encode("utf8"))
+
+
+def hash_password(password):
+    with metrics.timer("bcrypt", "hashpw"):
+        return run(bcrypt.hashpw, password.encode("utf8"), bcrypt.gensalt(BCRYPT_ROUNDS)).decode("utf8")
+
+
+def needs_rehash(hashed):
+    # hashes look like $2b$12$..., the middle field is the cost
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
@@ -0,0 +1,70 @@
+from decouple import config
+import threading
+import time
+
+# names are indexed as lowercase trigrams, each packed losslessly into one
+# 63 bit integer (three 21 bit code points) so equality never depends on the
+# database collation. two start markers make prefixes trigrams of their own
+SEARCH_LIMIT_MAX = config("SEARCH_LIMIT_MAX", default=200, cast=int)
+SEARCH_CANDIDATE_BATCH = config("SEARCH_CANDIDATE_BATCH", default=500, cast=int)
+# candidates must hold the SEARCH_JOIN_KEYS rarest query trigrams. posting
+# list sizes are kept per process for SEARCH_STATS_TTL seconds
+SEARCH_JOIN_KEYS = config("SEARCH_JOIN_KEYS", default=4, cast=int)
+SEARCH_STATS_TTL = config("SEARCH_STATS_TTL", default=300, cast=int)
+SEARCH_STATS_SIZE = config("SEARCH_STATS_SIZE", default=100000, cast=int)
+START = "\x02\x02"
+
+
+def pack(trigram):
+    return (ord(trigram[0]) << 42) | (ord(trigram[1]) << 21) | ord(trigram[2])
+
+
+def trigrams(text):
+    return {pack(text[i:i + 3]) for i in range(len(text) - 2)}
+
+
+def name_trigrams(name):
+    return trigrams(START + name.lower())
+
+
+def query_trigrams(query, prefix):
+    # a substring shorter than three characters has no trigram to look up
+    query = query.lower()
+    if prefix:
+        return trigrams(START + query)
+    return trigrams(query)
+
+
+def matches(name, query, prefix):
+    # trigram hits are candidates, this drops the ones whose trigrams are
+    # all present but not in the right order
+    name, query = name.lower(), query.lower()
+    return name.startswith(query) if prefix else query in name
+
+
+_lock = threading.Lock()
+_sizes = {}
+
+
+def cached_trigram_sizes(username, kind, keys):
+    now = time.monotonic()
+    sizes = {}
+    with _lock:
+        for key in keys:
+            cached = _sizes.get((username, kind, key), None)
+            if cached and now - cached[1] < SEARCH_STATS_TTL:
+                sizes[key] = cached[0]
+    return sizes
+
+
+def cache_trigram_sizes(username, kind, sizes):
+    now = time.monotonic()
+    with _lock:
+        if len(_sizes) + len(sizes) > SEARCH_STATS_SIZE:
+            for cache_key, (_, counted_at) in list(_sizes.items()):
+                if now - counted_at >= SEARCH_STATS_TTL:
+                    del _sizes[cache_key]
+            if len(_sizes) + len(sizes) > SEARCH_STATS_SIZE:
+                _sizes.clear()
+        for key, size in sizes.items():
+            _sizes[(username, kind, key)] = (size, now)
@@ -1,12 +1,10 @@
 from decouple import config
 from email.message import EmailMessage
-import ssl
-import smtplib
+import mail_queue
 
 
-def send_verification_email(destination, code):
+def build_verification_email(destination, code):
     app_username = config("GOOGLE_APP_USERNAME")
-    app_password = config("GOOGLE_APP_PASSWORD")
 
     subject = "Verify your account"
     body = f"Your verification code is {code}"
@@ -16,12 +14,13 @@ def send_verification_email(destination, code):
     em["To"] = destination
     em["Subject"] = subject
     em.set_content(body)
+    return em
+
 
+def send_verification_email(destination, code):
+    # delivery happens on the mail worker's pooled smtp session
     try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context) as smtp:
-            smtp.login(app_username, app_password)
-            smtp.sendmail(app_username, destination, em.as_string())
-    except:
-        print("send email failed")
-        raise Exception()
+        mail_queue.enqueue(build_verification_email(destination, code))
+    except Exception as e:
+        print("send email failed", e)
+        raise
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from decouple import config
+
+# "sync" is one request per gunicorn worker. "async" runs gevent workers, every
+# socket (s3, mysql, smtp) becomes cooperative and one process holds
+# thousands of in-flight requests. gunicorn.conf.py reads the same setting.
+S4_SERVING_MODE = config("S4_SERVING_MODE", default="sync")
+ASYNC_WORKER_CONNECTIONS = config("ASYNC_WORKER_CONNECTIONS", default=2000, cast=int)
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=50 if S4_SERVING_MODE == "async" else 5, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=50 if S4_SERVING_MODE == "async" else 10, cast=int)
+S3_MAX_POOL_CONNECTIONS = config("S3_MAX_POOL_CONNECTIONS",
+                                 default=500 if S4_SERVING_MODE == "async" else 10, cast=int)
+
+
+def is_async():
+    return S4_SERVING_MODE == "async"
+
+
+def engine_options(database_url):
+    # sqlite has no connection pool to size and no network socket to patch
+    if database_url.startswith("sqlite"):
+        return {}
+    options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_pre_ping": True}
+    if is_async() and database_url.startswith("mysql+mysqlconnector"):
+        # the c extension does its own blocking io, the pure driver uses
+        # gevent's patched sockets
+        options["connect_args"] = {"use_pure": True}
+    return options
+
+
+def s3_client_config():
+    return Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+
+
+def cpu_executor(max_workers, thread_name_prefix=""):
+    # once gevent has patched threading, a plain ThreadPoolExecutor runs on
+    # greenlets and cpu work (bcrypt, hashing) would stall every request
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            return NativeThreadPoolExecutor(max_workers=max_workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
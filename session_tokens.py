@@ -0,0 +1,94 @@
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from datetime import datetime
+from decouple import config
+import threading
+import hashlib
+import hmac
+import time
+
+# tokens only ever short-circuit validate_lp, a missing or rejected token
+# falls back to the LoginProcess lookup. every worker must sign with the same
+# key, so without SESSION_TOKEN_SECRET it is derived from the aws secret
+SESSION_TOKEN_SECRET = config("SESSION_TOKEN_SECRET", default="") or hmac.new(
+    config("AWS_SECRET_KEY").encode("utf8"), b"s4-session-token", hashlib.sha256).hexdigest()
+SESSION_TOKEN_MAX_AGE = config("SESSION_TOKEN_MAX_AGE", default=6000, cast=int)
+# how long a process trusts a token before confirming it against the db once,
+# this bounds how late a reset made by another worker is noticed; 0 never
+# rechecks and relies on the in-process revocation list only
+SESSION_TOKEN_RECHECK = config("SESSION_TOKEN_RECHECK", default=30, cast=int)
+SESSION_TOKEN_CACHE_SIZE = config("SESSION_TOKEN_CACHE_SIZE", default=10000, cast=int)
+
+serializer = URLSafeTimedSerializer(SESSION_TOKEN_SECRET, salt="s4-session")
+
+_lock = threading.Lock()
+_checked = {}
+_revoked = {}
+
+
+def window_digest(window_id):
+    # the payload is signed, not encrypted, and the window id is the session secret
+    return hmac.new(SESSION_TOKEN_SECRET.encode("utf8"), window_id.encode("utf8"), hashlib.sha256).hexdigest()
+
+
+def issue_token(lp):
+    return serializer.dumps({
+        "username": lp.username,
+        "window": window_digest(lp.window_id),
+        "created": lp.date_created.isoformat()
+    })
+
+
+def get_request_token(request):
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        return auth[len("Bearer "):]
+    return request.args.get("token", None)
+
+
+def read_token(token, username, window_id):
+    try:
+        data = serializer.loads(token, max_age=SESSION_TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+    if data.get("username") != username or not hmac.compare_digest(
+            str(data.get("window", "")), window_digest(window_id)):
+        return None
+    created = datetime.fromisoformat(data["created"])
+    if (datetime.utcnow() - created).total_seconds() > SESSION_TOKEN_MAX_AGE:
+        return None
+    with _lock:
+        revoked = _revoked.get(username, None)
+    if revoked and created < revoked:
+        return None
+    return data
+
+
+def is_trusted(token):
+    if SESSION_TOKEN_RECHECK <= 0:
+        return True
+    with _lock:
+        checked_at = _checked.get(token, None)
+    return checked_at is not None and time.monotonic() - checked_at < SESSION_TOKEN_RECHECK
+
+
+def mark_checked(token):
+    now = time.monotonic()
+    with _lock:
+        if len(_checked) >= SESSION_TOKEN_CACHE_SIZE:
+            for key, checked_at in list(_checked.items()):
+                if now - checked_at >= SESSION_TOKEN_RECHECK:
+                    del _checked[key]
+            if len(_checked) >= SESSION_TOKEN_CACHE_SIZE:
+                _checked.clear()
+        _checked[token] = now
+
+
+def revoke_tokens(username, created):
+    # every token minted for an older LoginProcess generation stops verifying
+    with _lock:
+        if len(_revoked) >= SESSION_TOKEN_CACHE_SIZE:
+            now = datetime.utcnow()
+            for key, revoked in list(_revoked.items()):
+                if (now - revoked).total_seconds() > SESSION_TOKEN_MAX_AGE:
+                    del _revoked[key]
+        _revoked[username] = created
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from decouple import config
+import hashlib
+
+from serving import cpu_executor
+
+# uploads at or above the threshold go through s3transfer as parallel
+# multipart uploads, memory per upload stays around chunksize * concurrency
+S3_MULTIPART_THRESHOLD = config("S3_MULTIPART_THRESHOLD", default=16 * 1024 * 1024, cast=int)
+S3_MULTIPART_CHUNKSIZE = config("S3_MULTIPART_CHUNKSIZE", default=8 * 1024 * 1024, cast=int)
+S3_MAX_CONCURRENCY = config("S3_MAX_CONCURRENCY", default=4, cast=int)
+
+# runs s3 transfers off the request thread so they overlap with db work
+S3_TRANSFER_WORKERS = config("S3_TRANSFER_WORKERS", default=8, cast=int)
+transfer_executor = ThreadPoolExecutor(max_workers=S3_TRANSFER_WORKERS, thread_name_prefix="s3-transfer")
+# sha256 is cpu work, under gevent it needs a real thread to not stall the hub
+S3_HASH_WORKERS = config("S3_HASH_WORKERS", default=2, cast=int)
+hash_executor = cpu_executor(S3_HASH_WORKERS, thread_name_prefix="s3-hash")
+
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY
+)
+
+
+def stream_size(stream):
+    try:
+        position = stream.tell()
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(position)
+        return size - position
+    except Exception:
+        return None
+
+
+def hash_file(file, chunk_size=1024 * 1024):
+    stream = getattr(file, "stream", file)
+    position = stream.tell()
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(position)
+    return digest.hexdigest(), size
+
+
+def upload_file(s3_client, bucket, key, file):
+    # werkzeug FileStorage wraps the spooled upload, s3transfer wants the raw stream
+    stream = getattr(file, "stream", file)
+    size = stream_size(stream)
+    if size is not None and size < S3_MULTIPART_THRESHOLD:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=stream)
+    else:
+        s3_client.upload_fileobj(stream, bucket, key, Config=transfer_config)
+    return size
+
+
+def get_object(s3_client, bucket, key, byte_range=None, if_none_match=None, if_modified_since=None):
+    # range and validators are forwarded so s3 does the matching and never
+    # sends a body we would throw away
+    args = {"Bucket": bucket, "Key": key}
+    if byte_range:
+        args["Range"] = byte_range
+    if if_none_match:
+        args["IfNoneMatch"] = if_none_match
+    elif if_modified_since:
+        args["IfModifiedSince"] = if_modified_since
+    try:
+        return s3_client.get_object(**args)
+    except ClientError as e:
+        metadata = e.response.get("ResponseMetadata", {})
+        status = metadata.get("HTTPStatusCode")
+        if status not in (304, 416):
+            raise
+        headers = metadata.get("HTTPHeaders", {})
+        return {
+            "StatusCode": status,
+            "ETag": headers.get("etag"),
+            "LastModified": headers.get("last-modified"),
+            "ObjectSize": e.response.get("Error", {}).get("ActualObjectSize")
+        }
+
+
+def delete_objects(s3_client, bucket, keys, batch_size=1000, executor=None):
+    # DeleteObjects accepts at most 1000 keys per request, with an executor
+    # the requests run in parallel
+    def delete_batch(batch):
+        res = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [{"Key": key} for key in batch],
+                "Quiet": True
+            }
+        )
+        return res.get("Errors", [])
+
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    if executor is None or len(batches) <= 1:
+        results = map(delete_batch, batches)
+    else:
+        results = executor.map(delete_batch, batches)
+    errors = []
+    for batch_errors in results:
+        errors.extend(batch_errors)
+    return errors
+
+
+def upload_files(s3_client, bucket, uploads, executor):
+    # uploads are (key, file) pairs, returns {key: exception} for the ones that failed
+    futures = {key: executor.submit(upload_file, s3_client, bucket, key, file) for key, file in uploads}
+    failed = {}
+    for key, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            failed[key] = e
+    return failed
@@ -1,19 +1,33 @@
+from functools import lru_cache
+from decouple import config
+import hashlib
 import pyotp
 import random
 import qrcode
 
+from utils import pil_img_to_io
 
-def generate_twoFA_code(username, key=None):
-    if not key:
-        key = pyotp.random_base32()
-    try:
-        uri = pyotp.totp.TOTP(key).provisioning_uri(
-            name=username, issuer_name="S4")
-        code_img = qrcode.make(uri)
-        return code_img, key
-    except Exception as e:
-        print(e)
-        return
+TWOFA_QR_CACHE_SIZE = config("TWOFA_QR_CACHE_SIZE", default=256, cast=int)
+
+
+def generate_twoFA_key():
+    return pyotp.random_base32()
+
+
+def twoFA_provisioning_uri(username, key):
+    return pyotp.totp.TOTP(key).provisioning_uri(
+        name=username, issuer_name="S4")
+
+
+def twoFA_code_etag(uri):
+    return hashlib.sha256(uri.encode("utf8")).hexdigest()[:32]
+
+
+# keyed by the provisioning uri, so a rotated key simply misses the cache
+@lru_cache(maxsize=TWOFA_QR_CACHE_SIZE)
+def render_twoFA_code(uri):
+    code_img = qrcode.make(uri)
+    return pil_img_to_io(code_img).getvalue()
 
 
 def compare_twoFA_code(key, code):
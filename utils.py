@@ -1,7 +1,9 @@
 from io import BytesIO
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import json
 from flask import Response
-import os
 from datetime import datetime
+from session_tokens import revoke_tokens
 
 
 def pil_img_to_io(img):
@@ -16,25 +18,34 @@ def send_404(message):
     return Response(data, status=404, mimetype='application/json')
 
 
+def send_429(message):
+    data = "{'errorMessage':'" + message + "'}"
+    return Response(data, status=429, mimetype='application/json')
+
+
+def send_503(message):
+    data = "{'errorMessage':'" + message + "'}"
+    return Response(data, status=503, mimetype='application/json')
+
+
 def send_200(message, data=None):
     if not data:
         data = "{'successMessage':'" + message + "'}"
     return Response(data, status=200, mimetype='application/json')
 
 
-def remove_files(files):
-    for filename in files:
-        try:
-            os.remove(filename)
-        except:
-            continue
-
-
 def reset_lp(lp, window_id):
     lp.window_id = window_id
     lp.twoFA_verified = False
     # lp.fc_verified = False
     lp.date_created = datetime.utcnow()
+    revoke_tokens(lp.username, lp.date_created)
+
+
+def get_file_extension(file_name, content_type):
+    if content_type == "text/plain":
+        return file_name.split(".")[-1]
+    return content_type.split("/")[-1]
 
 
 def directory_to_dict(directory):
@@ -56,4 +67,22 @@ def file_to_dict(file):
         "name": file.name,
         "s3Name": file.s3_name,
         "contentType": file.content_type
-    }
\ No newline at end of file
+    }
+
+def encode_cursor(kind, value, row_id):
+    # opaque to clients, it only carries the last row of the previous page
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([kind, value, row_id], separators=(",", ":")).encode("utf8")
+    return urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, date_value=False):
+    # raises ValueError for anything that is not a cursor we issued
+    try:
+        kind, value, row_id = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if kind not in ("d", "f") or not isinstance(value, str) or not isinstance(row_id, int):
+        raise ValueError("invalid cursor")
+    return kind, datetime.fromisoformat(value) if date_value else value, row_id
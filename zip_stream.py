@@ -0,0 +1,117 @@
+from collections import deque
+from decouple import config
+import zipfile
+
+# the archive is written as it is read, memory stays around
+# ZIP_PREFETCH * ZIP_PREFETCH_BYTES + ZIP_CHUNK_SIZE whatever the subtree size
+ZIP_CHUNK_SIZE = config("ZIP_CHUNK_SIZE", default=256 * 1024, cast=int)
+ZIP_PREFETCH = config("ZIP_PREFETCH", default=4, cast=int)
+ZIP_PREFETCH_BYTES = config("ZIP_PREFETCH_BYTES", default=1024 * 1024, cast=int)
+
+# deflate gains nothing on these, they go into the archive as they are
+STORED_CONTENT_TYPES = (
+    "image/", "video/", "audio/", "font/woff",
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/x-7z-compressed", "application/vnd.rar", "application/x-rar-compressed",
+    "application/pdf", "application/epub+zip", "application/java-archive",
+    "application/vnd.openxmlformats-officedocument.",
+)
+COMPRESSED_CONTENT_TYPES = ("image/svg+xml", "image/bmp", "image/tiff", "audio/wav", "audio/x-wav")
+
+
+def compress_type(content_type):
+    content_type = (content_type or "").lower()
+    if content_type.startswith(COMPRESSED_CONTENT_TYPES):
+        return zipfile.ZIP_DEFLATED
+    if content_type.startswith(STORED_CONTENT_TYPES):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def archive_name(name):
+    # names are user input, keep them from adding or leaving path segments
+    name = name.replace("/", "_").replace("\\", "_").strip()
+    return "_" if name in ("", ".", "..") else name
+
+
+class ChunkSink:
+    # zipfile writes here, the generator hands whatever piled up to the client
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def open_object(s3_client, bucket, key):
+    res = s3_client.get_object(Bucket=bucket, Key=key)
+    body = res["Body"]
+    return body.read(ZIP_PREFETCH_BYTES), body, res["ContentLength"]
+
+
+def close_prefetched(future):
+    if future is None or future.cancel():
+        return
+    try:
+        future.result()[1].close()
+    except Exception:
+        pass
+
+
+def stream_zip(entries, s3_client, bucket, executor):
+    # entries are (archive name, s3 key, content type, datetime), directories
+    # end in "/" and have no key. the next ZIP_PREFETCH objects are requested
+    # while the current one is compressed
+    sink = ChunkSink()
+    entries = iter(entries)
+    pending = deque()
+
+    def schedule():
+        while len(pending) < ZIP_PREFETCH:
+            entry = next(entries, None)
+            if entry is None:
+                return
+            key = entry[1]
+            pending.append((entry, executor.submit(open_object, s3_client, bucket, key) if key else None))
+
+    try:
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+            schedule()
+            while pending:
+                (name, key, content_type, date_created), future = pending.popleft()
+                schedule()
+                info = zipfile.ZipInfo(name, date_time=max(date_created.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+                if future is None:
+                    info.external_attr = 0o40755 << 16 | 0x10
+                    archive.writestr(info, b"")
+                else:
+                    head, body, size = future.result()
+                    info.file_size = size
+                    info.compress_type = compress_type(content_type)
+                    try:
+                        with archive.open(info, "w") as member:
+                            member.write(head)
+                            for chunk in iter(lambda: body.read(ZIP_CHUNK_SIZE), b""):
+                                member.write(chunk)
+                                data = sink.take()
+                                if data:
+                                    yield data
+                    finally:
+                        body.close()
+                data = sink.take()
+                if data:
+                    yield data
+        yield sink.take()
+    finally:
+        # a client that hangs up leaves prefetched responses open
+        for _, future in pending:
+            close_prefetched(future)